@@ -0,0 +1,76 @@
+"""
+Build time of the report body as a function of the number of copied tables.
+
+Compares the append cursor used by copy_table with the previous lookup of
+output_doc.paragraphs[-1] for every table. Only the copies are timed: the
+headings between them cost the same with both. The run fails if the cursor
+does not stay flat per table or is not clearly ahead of the lookup at the
+largest size. Run from the repository root:
+
+    python Benchmarks/build_scaling.py
+"""
+import os
+import sys
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+from word_formatter import add_h3, copy_table
+
+TABLE_COUNTS = [50, 100, 200, 400, 800]
+# Builds per size, the fastest one counts
+REPEATS = 3
+# Allowed growth of the cursor's time per table from the smallest to the largest size
+MAX_CURSOR_GROWTH = 3.0
+# The lookup must be at least this much slower per table at the largest size
+MIN_LOOKUP_RATIO = 2.0
+
+
+def copy_table_lookup(output_doc, table):
+    # The previous implementation, kept here for comparison
+    p = output_doc.paragraphs[-1]
+    new_tbl = deepcopy(table._tbl)
+    p._p.addnext(new_tbl)
+
+
+def sample_table():
+    raw = Document()
+    table = raw.add_table(rows=6, cols=3)
+    for r, row in enumerate(table.rows):
+        for c, cell in enumerate(row.cells):
+            cell.text = f"Zeile {r} Spalte {c}"
+    return table
+
+
+def build(copy, table, count):
+    """
+    Seconds spent in `copy` while building a body of `count` tables.
+    """
+    doc = Document()
+    spent = 0
+    for i in range(count):
+        add_h3(doc, f"Tabelle {i}")
+        started = time.perf_counter()
+        copy(doc, table)
+        spent += time.perf_counter() - started
+    return spent
+
+
+if __name__ == "__main__":
+    table = sample_table()
+    per_table = {}
+    print(f"{'tables':>8} {'cursor ms':>10} {'per table':>10} {'lookup ms':>10} {'per table':>10}")
+    for count in TABLE_COUNTS:
+        cursor = min(build(copy_table, table, count) for _ in range(REPEATS))
+        lookup = min(build(copy_table_lookup, table, count) for _ in range(REPEATS))
+        per_table[count] = (cursor / count, lookup / count)
+        print(f"{count:>8} {cursor*1000:>10.1f} {cursor*1e6/count:>8.0f}us {lookup*1000:>10.1f} {lookup*1e6/count:>8.0f}us")
+
+    smallest, largest = per_table[TABLE_COUNTS[0]], per_table[TABLE_COUNTS[-1]]
+    growth = largest[0] / smallest[0]
+    ratio = largest[1] / largest[0]
+    print(f"cursor growth per table {growth:.1f}x, lookup/cursor at {TABLE_COUNTS[-1]} tables {ratio:.1f}x")
+    assert growth <= MAX_CURSOR_GROWTH, f"cursor time per table grew {growth:.1f}x"
+    assert ratio >= MIN_LOOKUP_RATIO, f"lookup only {ratio:.1f}x slower than the cursor"
@@ -0,0 +1,21 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from word_formatter import LeaseQueue
+
+
+def test_report_dropped_again_is_leased_again(tmp_path):
+    queue = LeaseQueue(str(tmp_path / 'leases'), timeout=60)
+    src_path = tmp_path / 'offer.docx'
+    src_path.write_bytes(b'v1')
+    queue.put(('offer.docx', str(src_path)))
+    assert queue.get(timeout=1) == ('offer.docx', str(src_path))
+    queue.task_done()
+    # The job finished and removed the report; its revision arrives before the heartbeat ran
+    src_path.unlink()
+    src_path.write_bytes(b'v2')
+    queue.put(('offer.docx', str(src_path)))
+    assert queue.get(timeout=1) == ('offer.docx', str(src_path))
+    assert not queue.waiting
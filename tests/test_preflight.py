@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import word_formatter
+from word_formatter import handle_failed_job, parse_input
+
+
+def test_corrupt_report_is_rejected_with_a_reason(tmp_path, monkeypatch):
+    watch_folder, invalid_folder = tmp_path / 'input', tmp_path / 'invalid'
+    watch_folder.mkdir()
+    invalid_folder.mkdir()
+    monkeypatch.setattr(word_formatter, 'INVALID_FOLDER', str(invalid_folder))
+    monkeypatch.setattr(word_formatter, 'JOURNAL_DB', None)
+    src_path = watch_folder / 'broken.docx'
+    src_path.write_bytes(b'PK\x03\x04 truncated')
+    job = {'file_name': 'broken.docx', 'src_path': str(src_path), 'data': src_path.read_bytes()}
+    try:
+        parse_input(job)
+    except Exception as e:
+        handle_failed_job(job['file_name'], job['src_path'], exc_info=e)
+    reasons = (invalid_folder / 'broken.docx.txt').read_text(encoding='utf-8')
+    assert reasons.startswith('not a valid .docx: ')
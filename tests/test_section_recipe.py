@@ -0,0 +1,24 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from docx import Document
+
+from word_formatter import SECTION_RECIPE, RawSnapshot, RenderState, compile_recipe, render_sections
+
+
+def test_wechselrichter_line_before_verschaltung_copies_no_table():
+    raw_document = Document()
+    raw_document.add_table(rows=1, cols=1)
+    raw_document.add_heading("Wechselrichterverschaltung", level=2)
+    raw_document.add_paragraph("Wechselrichter 1: SMA Sunny Tripower")
+    raw_document.add_paragraph("Verschaltung Dach Süd")
+    raw_document.add_table(rows=1, cols=1)
+    raw_document.add_paragraph("Wechselrichter 2: SMA Sunny Boy")
+    raw_document.add_table(rows=1, cols=1)
+    raw_document.add_heading("Ergebnisse", level=1)
+    recipe = compile_recipe([entry for entry in SECTION_RECIPE if entry.get('heading') == "Wechselrichterverschaltung"])
+    state = RenderState(None, RawSnapshot(raw_document), None)
+    render_sections(state, recipe)
+    assert state.usage == [("Wechselrichterverschaltung", 2, 0)]
@@ -0,0 +1,104 @@
+"""
+Client of the warm worker (python word_formatter.py warm).
+
+    python warm_client.py REPORT.docx ...
+
+Converts the reports in the running warm worker with its template and output folder. Only
+the standard library is imported here, so a one-shot conversion does not pay for the render
+dependencies. Without a warm worker the reports are converted in this process by
+`python word_formatter.py convert`.
+"""
+import os
+import sys
+import json
+import runpy
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+# Local port of the warm worker that one-shot conversions use
+WARM_PORT = 9465
+# Random key of the warm worker, created by it next to this script and readable by the service user only
+WARM_KEY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'warm_worker.key')
+
+
+class WarmJobError(RuntimeError):
+    """
+    A job failed in the warm worker. `reasons` lists the problems when preflight rejected
+    the report, None otherwise.
+    """
+    def __init__(self, error, reasons=None):
+        super().__init__(f"in the warm worker: {error}")
+        self.reasons = reasons
+
+
+def warm_authkey(create=False):
+    """
+    Key the warm worker and its clients authenticate with, read from WARM_KEY_FILE. With
+    create, a missing key is generated; the file is created readable by its owner only (on
+    Windows it gets the permissions of its folder).
+
+    Raises:
+        FileNotFoundError: There is no key and `create` is False.
+    """
+    try:
+        with open(WARM_KEY_FILE, 'rb') as fp:
+            return fp.read()
+    except FileNotFoundError:
+        if not create:
+            raise
+    key = os.urandom(32)
+    fd = os.open(WARM_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(key)
+    return key
+
+
+def warm_render(file_name, data, template_path=None, port=WARM_PORT):
+    """
+    Render one job in the warm worker, with its own template unless `template_path` is given.
+
+    Returns:
+        tuple: The saved offer document and the output folder of the warm worker.
+
+    Raises:
+        ConnectionRefusedError: No warm worker is listening on `port`.
+        FileNotFoundError: No warm worker has run yet, so there is no key.
+        WarmJobError: The job failed in the warm worker.
+    """
+    with Client(('127.0.0.1', port), authkey=warm_authkey()) as conn:
+        request = {'file_name': file_name,
+                   'template_path': os.path.abspath(template_path) if template_path else None}
+        conn.send_bytes(json.dumps(request).encode('utf-8'))
+        conn.send_bytes(data)
+        reply = json.loads(conn.recv_bytes())
+        if reply['ok']:
+            return conn.recv_bytes(), reply['output_folder']
+    raise WarmJobError(reply['error'], reply.get('reasons'))
+
+
+def convert(src_paths):
+    """
+    Convert the reports in the warm worker, the rest in this process once none is listening.
+    """
+    for idx, src_path in enumerate(src_paths):
+        file_name = os.path.basename(src_path)
+        with open(src_path, 'rb') as fp:
+            data = fp.read()
+        try:
+            output, output_folder = warm_render(file_name, data)
+        except (ConnectionRefusedError, FileNotFoundError):
+            script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'word_formatter.py')
+            sys.argv = [script, 'convert', *src_paths[idx:]]
+            runpy.run_path(script, run_name='__main__')
+            return
+        output_path = os.path.join(output_folder, f'{file_name}-output.docx')
+        with open(output_path, 'wb') as fp:
+            fp.write(output)
+        print(f'{file_name}-output.docx created')
+
+
+if __name__ == "__main__":
+    try:
+        convert(sys.argv[1:])
+    except (WarmJobError, AuthenticationError) as e:
+        sys.exit(f"{type(e).__name__}: {e}")
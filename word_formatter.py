@@ -1,39 +1,132 @@
 import os
+import sys
 import shutil
-from pypdf import PdfReader
-from docx2pdf import convert
+import asyncio
+import multiprocessing
+import traceback
+import tempfile
+import zipfile
+import hashlib
+import sqlite3
+import json
+import atexit
+import bisect
+import heapq
+import itertools
+import cProfile
+import pstats
+import tracemalloc
+import socket
+import importlib
+from xml.etree import ElementTree
 from docx import Document
+from docx.table import Table
 from docx.enum.text import WD_ALIGN_PARAGRAPH, WD_LINE_SPACING
 from docx.shared import Inches, RGBColor, Cm, Pt
 from copy import deepcopy
-from docx.oxml import OxmlElement
+from io import BytesIO
+from docx.oxml import OxmlElement, parse_xml
+from lxml import etree
+from collections import OrderedDict
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar, copy_context
+from io import StringIO
 
 from docx.oxml.ns import qn
 from docx.oxml.ns import nsdecls
 
 import time
-from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
 import logging
-from queue import Queue
-from threading import Thread
-from PIL import Image
+from logging.handlers import QueueHandler, QueueListener
+from queue import Empty, Queue
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Condition, Event, Lock, Thread
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+# The warm worker's port and key (WARM_PORT, WARM_KEY_FILE) are set there
+from warm_client import WARM_PORT, WarmJobError, warm_authkey, warm_render
+try:
+    import psutil
+except ImportError:
+    # Needed for JOB_MAX_RSS: without it the limit is not enforced outside Linux, and on
+    # Linux it ignores the section processes (see check_memory_limit)
+    psutil = None
 
 # Configure the logger
 verb= 0
 count = 0
+# Set per job: 0 for reports whose name starts with '0'
+flag = 1
 logging.basicConfig(filename='error_log.txt', 
                     level=logging.ERROR, 
                     format='%(asctime)s %(levelname)s:%(message)s')
+# Progress and diagnostics of the jobs; silent until setup_logging() is called
+log = logging.getLogger('word_formatter')
+# Level of the console log; the per-job log files get everything
+LOG_LEVEL = logging.INFO
+# Folder of the per-job log files (JSON lines) next to this script, None to disable
+JOB_LOG_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'logs')
+# Per-job log files are removed after this many seconds
+JOB_LOG_MAX_AGE = 30 * 24 * 3600
 INVALID_FOLDER = 'invalid/'
+# Reports whose rendering was aborted (JOB_TIMEOUT, JOB_MAX_RSS, crash) are moved here
+QUARANTINE_FOLDER = 'quarantine/'
+# Limits of one render job in the pipeline: wall-clock seconds and resident memory in bytes, None to disable
+JOB_TIMEOUT = 600
+JOB_MAX_RSS = 2 * 1024 ** 3
+# SQLite index of processed offers, None to disable
+INDEX_DB = 'offer_index.sqlite'
+# Folder of pre-styled datasheet tables, None to disable
+FRAGMENT_CACHE_DIR = 'fragment_cache'
+# Folder of rendered sections per offer, reused for its revisions; None to disable
+REVISION_CACHE_DIR = 'revision_cache'
+# Check the structure of every report before rendering it (see preflight)
+PREFLIGHT = True
+# File operations failing on a locked file (OneDrive, Word) are retried in the background:
+# number of attempts and first delay in seconds, doubled after every attempt
+RETRY_ATTEMPTS = 6
+RETRY_DELAY = 1
+# Deflate level of the XML parts of saved offers, 1 (fastest) to 9 (smallest)
+SAVE_DEFLATE_LEVEL = 6
+# Media that is compressed already and stored as is when saving an offer
+STORED_MEDIA = ('.png', '.jpg', '.jpeg', '.gif', '.jp2', '.wdp')
+# SQLite journal of queued and running jobs, used to catch up after a restart; None to disable
+JOURNAL_DB = 'job_journal.sqlite'
+# A report the service died on this many times is quarantined by the startup scan
+JOURNAL_MAX_ATTEMPTS = 3
+# Poll the watch folder instead of relying on filesystem events (OneDrive and SMB shares):
+# None for native events, else the (fastest, slowest) poll interval in seconds
+POLL_INTERVALS = None
+# Shared folder of job leases when several machines watch the same input folders, None for one machine.
+# Not inside a watch folder: the cleanup after every job removes the folders in there.
+LEASE_DIR = None
+# A lease not refreshed for this many seconds is taken over by another machine
+LEASE_TIMEOUT = 120
+# Port of the local Prometheus endpoint (http://127.0.0.1:<port>/metrics), None to disable
+METRICS_PORT = 9464
+# Reports with this marker in their name, or all reports while the DOCGEN_PROFILE environment
+# variable is set, are rendered under cProfile and tracemalloc (see profiled)
+PROFILE_MARKER = '.profile'
+# Functions and allocation sites listed in a profile summary
+PROFILE_TOP = 30
+# Offers with at least SECTION_MIN_TABLES tables have their sections rendered in parallel in
+# up to SECTION_WORKERS processes and merged in order (1 renders every offer in one process)
+SECTION_WORKERS = min(4, os.cpu_count() or 1)
+SECTION_MIN_TABLES = 40
 
 
 def add_page_numbers(doc):
     """
-    Add page numbers to each section's footer in the document.
+    Add page numbers to each section's footer in the document. Footers shared by
+    several sections get a single page number field.
     """
+    done = set()
     for section in doc.sections:
         footer = section.footer
+        if footer.part in done:
+            continue
+        done.add(footer.part)
         paragraph = footer.paragraphs[0] if footer.paragraphs else footer.add_paragraph()
         paragraph.alignment = WD_ALIGN_PARAGRAPH.RIGHT
         
@@ -78,24 +171,34 @@ def extract_module_name_from_specific_cell(doc):
     try:
         # Access Table 5, Row 1, Cell 1
         cell_text = doc.tables[5].rows[1].cells[1].text.strip()
-        print(f"Extracted raw module name: {cell_text}")
-
-        # Split the text to remove the quantity part (e.g., "9 x ") and other unwanted details
-        parts = cell_text.split("x", 1)  # Split at the first 'x'
-        if len(parts) > 1:
-            # Extract only the module name, removing version and other extra parts
-            module_name = parts[1].strip()
-            module_name_parts = module_name.split()  # Split into components
-            clean_module_name = " ".join(module_name_parts[:5])  # Combine first 4 parts for the module name
-            print(f"Formatted module name: {clean_module_name}")
+        log.debug(f"Extracted raw module name: {cell_text}")
+
+        clean_module_name = clean_module_text(cell_text)
+        if clean_module_name:
+            log.debug(f"Formatted module name: {clean_module_name}")
             return clean_module_name
         else:
-            print("Module name format unexpected; unable to split.")
+            log.warning("Module name format unexpected; unable to split.")
             return None
 
     except IndexError:
-        print("Failed to extract module name from the specified table and cell.")
+        log.warning("Failed to extract module name from the specified table and cell.")
         return None
+
+
+def clean_module_text(cell_text):
+    """
+    Turn the "PV-Module" cell text (e.g. "9 x IBC MonoSol 450 MS10-HC-N GEN2 (S24) (v1)")
+    into the module name, or None if the text has no quantity part.
+    """
+    # Split the text to remove the quantity part (e.g., "9 x ") and other unwanted details
+    parts = cell_text.split("x", 1)  # Split at the first 'x'
+    if len(parts) > 1:
+        # Extract only the module name, removing version and other extra parts
+        module_name = parts[1].strip()
+        module_name_parts = module_name.split()  # Split into components
+        return " ".join(module_name_parts[:5])  # Combine first 4 parts for the module name
+    return None
 def update_module_name(doc):
     """
     Updates the module name on the cover page to match the one extracted from a specific cell.
@@ -107,7 +210,7 @@ def update_module_name(doc):
     module_name = extract_module_name_from_specific_cell(doc)
     
     if not module_name:
-        print("Module name not found; cannot update cover page.")
+        log.warning("Module name not found; cannot update cover page.")
         return
 
     # Replace the module name on the cover page
@@ -116,7 +219,7 @@ def update_module_name(doc):
         if "IBC MonoSol" in para.text:  # Assuming this is the placeholder on the cover
             cover_page_found = True
             # Debugging: Log before replacement
-            print(f"Original paragraph: {para.text}")
+            log.debug(f"Original paragraph: {para.text}")
             
             # Clear the existing text
             para.clear()
@@ -132,43 +235,50 @@ def update_module_name(doc):
             # Set paragraph alignment to center (if needed)
             para.alignment = WD_ALIGN_PARAGRAPH.CENTER
             
-            print(f"Updated paragraph with module name as H2: {para.text}")  # Debugging output
+            log.debug(f"Updated paragraph with module name as H2: {para.text}")
             break
 
     if not cover_page_found:
-        print("Cover page module name placeholder not found.")
+        log.warning("Cover page module name placeholder not found.")
+
+
+def darken_first_row_bottom_border(document, preformatted=()):
+    for table in document.tables:
+        if table._tbl not in preformatted:
+            darken_table_first_row(table)
 
 
-def darken_first_row_bottom_border(document):
+def darken_table_first_row(table):
     # Define the namespace URI directly in the attribute setting
     namespace_uri = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
 
-    for table in document.tables:
-        if table.rows:  # Check if there are rows in the table
-            first_row = table.rows[0]
-            for cell in first_row.cells:
-                # Accessing the cell's XML and ensuring it has tcBorders
-                tc = cell._element
-                tcBorders = tc.find('.//w:tcBorders', namespaces={'w': namespace_uri})
-                if tcBorders is None:
-                    tcBorders = OxmlElement('w:tcBorders')
-                    tc.append(tcBorders)
-                
-                # Modify or add the bottom border to be darker and thicker
-                bottom_border = tcBorders.find('.//w:top', namespaces={'w': namespace_uri})
-                if bottom_border is None:
-                    bottom_border = OxmlElement('w:top')
-                    tcBorders.append(bottom_border)
-                
-                # Set the style of the border
-                bottom_border.set(f'{{{namespace_uri}}}val', 'single')  # Style of the border
-                bottom_border.set(f'{{{namespace_uri}}}sz', '5')       # Size of the border, making it thicker
-                bottom_border.set(f'{{{namespace_uri}}}color', '000000')  # Color of the border, making it black
+    if table.rows:  # Check if there are rows in the table
+        first_row = table.rows[0]
+        for cell in first_row.cells:
+            # Accessing the cell's XML and ensuring it has tcBorders
+            tc = cell._element
+            tcBorders = tc.find('.//w:tcBorders', namespaces={'w': namespace_uri})
+            if tcBorders is None:
+                tcBorders = OxmlElement('w:tcBorders')
+                tc.append(tcBorders)
+            
+            # Modify or add the bottom border to be darker and thicker
+            bottom_border = tcBorders.find('.//w:top', namespaces={'w': namespace_uri})
+            if bottom_border is None:
+                bottom_border = OxmlElement('w:top')
+                tcBorders.append(bottom_border)
+            
+            # Set the style of the border
+            bottom_border.set(f'{{{namespace_uri}}}val', 'single')  # Style of the border
+            bottom_border.set(f'{{{namespace_uri}}}sz', '5')       # Size of the border, making it thicker
+            bottom_border.set(f'{{{namespace_uri}}}color', '000000')  # Color of the border, making it black
 
 def convert_jp2_to_jpg(image_path):
     """
     Convert a .jp2 image to .jpg format with a white background.
     """
+    from PIL import Image
+
     # Load the jp2 image
     with Image.open(image_path) as img:
         # Create a new white background image
@@ -180,13 +290,13 @@ def convert_jp2_to_jpg(image_path):
         # Save the new image as .jpg
         jpg_path = image_path.replace('.jp2', '.jpg')
         white_background.save(jpg_path, 'JPEG')
-        print(f"Converted {image_path} to {jpg_path}")
+        log.debug(f"Converted {image_path} to {jpg_path}")
         
     return jpg_path
 def clear_folder_contents(file_name, folder_path):
     # Check if the folder exists
     if not os.path.exists(folder_path):
-        print(f"Folder does not exist: {folder_path}")
+        log.warning(f"Folder does not exist: {folder_path}")
         return
     
     # Iterate through the files and directories in the folder
@@ -196,44 +306,64 @@ def clear_folder_contents(file_name, folder_path):
             if os.path.isfile(path):
                 if path.endswith('.docx'):
                     if file_or_dir == file_name or file_or_dir.startswith('~$'):
-                        print(f"Removing file: {path}")
-                        os.remove(path)
+                        log.debug(f"Removing file: {path}")
+                        retries.run(f"remove {path}", os.remove, path)
                 else:
-                    print(f"Removing file: {path}")
-                    os.remove(path)
+                    log.debug(f"Removing file: {path}")
+                    retries.run(f"remove {path}", os.remove, path)
             elif os.path.isdir(path):
-                print(f"Removing directory and its contents: {path}")
-                shutil.rmtree(path)
+                log.debug(f"Removing directory and its contents: {path}")
+                retries.run(f"remove {path}", shutil.rmtree, path)
         except Exception as e:
-            print(f"Failed to remove {path}. Reason: {e}")
+            log.warning(f"Failed to remove {path}. Reason: {e}")
 
 
-def set_font_to_barlow(output_doc):
+def set_font_to_barlow(output_doc, preformatted=()):
     # Iterate through all paragraphs in the document
     for paragraph in output_doc.paragraphs:
         for run in paragraph.runs:
             run.font.name = 'Barlow'
     
-    # Iterate through all tables in the document
+    # Iterate through all tables in the document, skipping the ones spliced in already styled
     for table in output_doc.tables:
-        for row in table.rows:
-            for cell in row.cells:
-                for paragraph in cell.paragraphs:
-                    for run in paragraph.runs:
-                        run.font.name = 'Barlow'
+        if table._tbl not in preformatted:
+            set_table_font(table)
 
-        # Set font in headers and footers
+    # Set font in headers and footers, once per part when sections share them
+    done = set()
     for section in output_doc.sections:
-        header = section.header
-        for paragraph in header.paragraphs:
-            for run in paragraph.runs:
-                run.font.name = 'Barlow'
-                
-        footer = section.footer
-        for paragraph in footer.paragraphs:
-            for run in paragraph.runs:
-                run.font.name = 'Barlow'
+        for header_footer in (section.header, section.footer):
+            if header_footer.part in done:
+                continue
+            done.add(header_footer.part)
+            for paragraph in header_footer.paragraphs:
+                for run in paragraph.runs:
+                    run.font.name = 'Barlow'
+
+
+def set_table_font(table, font_name='Barlow'):
+    for row in table.rows:
+        for cell in row.cells:
+            for paragraph in cell.paragraphs:
+                for run in paragraph.runs:
+                    run.font.name = font_name
+
+
+def link_headers_and_footers(doc):
+    """
+    Let every section after the first reuse the header and footer parts of the first one,
+    so they are built (and the logo embedded) only once.
+    """
+    for section in doc.sections[1:]:
+        section.header.is_linked_to_previous = True
+        section.footer.is_linked_to_previous = True
+        section.first_page_header.is_linked_to_previous = True
+        section.first_page_footer.is_linked_to_previous = True
 def extract_raw_document_images(filepath):
+    # Heavy and only needed here, so not imported with the module
+    from docx2pdf import convert
+    from pypdf import PdfReader
+
     fileName = os.path.basename(filepath)
     folder_path = os.path.dirname(filepath)
 
@@ -296,20 +426,30 @@ def add_h1(output_doc, text):
     run.font.size = Pt(24)
     run.font.color.rgb = RGBColor(250, 168, 32)
        
+# Font of the 'Heading n' styles, set on the document by add_h2 and add_h3: (size, color)
+HEADING_FONTS = {
+    2: (200000, RGBColor(250, 168, 32)),
+    3: (150000, RGBColor(128, 128, 128)),
+}
+
+
+def set_heading_style(output_doc, level):
+    style = output_doc.styles[f'Heading {level}']
+    size, color = HEADING_FONTS[level]
+    style.font.name = 'Barlow'
+    style.font.size = size
+    style.font.bold = False
+    style.font.color.rgb = color
+
+
 def add_h2(output_doc, text):
     heading = output_doc.add_heading(text, 2)
-    heading.style.font.name = 'Barlow'
-    heading.style.font.size = 200000
-    heading.style.font.bold = False
+    set_heading_style(output_doc, 2)
     heading.line_spacing_rule = WD_LINE_SPACING.SINGLE
-    heading.style.font.color.rgb = RGBColor(250, 168, 32)
     
 def add_h3(output_doc, text):
-    heading = output_doc.add_heading(text, 3)
-    heading.style.font.name = 'Barlow'
-    heading.style.font.size = 150000
-    heading.style.font.bold = False
-    heading.style.font.color.rgb = RGBColor(128, 128, 128)
+    output_doc.add_heading(text, 3)
+    set_heading_style(output_doc, 3)
 
 def set_table_borders(table, color="E8E9EB"):
     """
@@ -367,37 +507,48 @@ def remove_vertical_borders(table):
                 tcBorders.append(border_element)
             border_element.set(qn('w:val'), 'nil')
 
-def format_table(output_doc):
+# Column widths by number of cells in a row; rows with other cell counts keep the widths of the row before
+TABLE_WIDTHS = {
+    2: (Inches(6), Inches(6)),
+    3: (Inches(6.5), Inches(4.5), Inches(2)),
+    4: (Inches(4), Inches(3), Inches(1), Inches(4)),
+    5: (Inches(2), Inches(4), Inches(3), Inches(2), Inches(2)),
+    6: (Inches(2), Inches(2), Inches(2), Inches(2), Inches(2), Inches(2)),
+    7: (Inches(0.5), Inches(2), Inches(2), Inches(2), Inches(2.5), Inches(1.5), Inches(1.5)),
+}
+
+
+def format_table(output_doc, preformatted=()):
     width = (Inches(4.5), Inches(4.5), Inches(1.5))
-    t = 0
     for table in output_doc.tables:
-        table.style = "Table Grid"
-        set_table_borders(table, color="E8E9EB")  # Set the border color to gray
-        darken_title_line(table)  # Darken the line after the title
-
-        i = 0
-        for r in table.rows:
-            j=0
-            if len(table.rows[i].cells) == 2:
-                width = (Inches(6), Inches(6))
-            elif len(table.rows[i].cells) == 3:
-                width = (Inches(6.5), Inches(4.5), Inches(2))
-            elif len(table.rows[i].cells) == 4:
-                width = (Inches(4), Inches(3), Inches(1), Inches(4))
-            elif len(table.rows[i].cells) == 5:
-                width = (Inches(2), Inches(4), Inches(3), Inches(2), Inches(2))
-            elif len(table.rows[i].cells) == 6:
-                width = (Inches(2), Inches(2), Inches(2), Inches(2), Inches(2), Inches(2))
-            elif len(table.rows[i].cells) == 7:
-                width = (Inches(0.5), Inches(2), Inches(2), Inches(2), Inches(2.5), Inches(1.5), Inches(1.5))
-            for cell in table.rows[i].cells:
-                table.rows[i].cells[j].width = width[j]
-                for paragraph in cell.paragraphs:
-                    paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
-                j+=1
-            i+=1
-        t+=1
-        remove_vertical_borders(table)
+        if table._tbl in preformatted:
+            # Already styled, only carry the widths on to the next table
+            for row in table.rows:
+                width = TABLE_WIDTHS.get(len(row.cells), width)
+            continue
+        width = format_single_table(table, width)
+
+
+def format_single_table(table, width):
+    """
+    Style one table and set its column widths.
+
+    Returns:
+        tuple: The widths of the last row, used for the next table's rows of unknown size.
+    """
+    table.style = "Table Grid"
+    set_table_borders(table, color="E8E9EB")  # Set the border color to gray
+    darken_title_line(table)  # Darken the line after the title
+
+    for row in table.rows:
+        cells = row.cells
+        width = TABLE_WIDTHS.get(len(cells), width)
+        for j, cell in enumerate(cells):
+            cell.width = width[j]
+            for paragraph in cell.paragraphs:
+                paragraph.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    remove_vertical_borders(table)
+    return width
 def add_cell_to_row(row):
     """
     Add a new cell to a row in a Word table by manipulating the underlying XML.
@@ -443,9 +594,10 @@ def set_column_widths(table, widths):
                 tcPr.append(tcW)
 
                 
-def format_table_with_picture(output_doc, tableNo, imagePath):
-    # Set the table style
-    table = output_doc.tables[tableNo]
+def format_table_with_picture(output_doc, tableNo, imagePath, name=None):
+    # Set the table style, tableNo is an index into output_doc.tables or the table itself.
+    # imagePath may also be a stream, then `name` is the file name given to the picture
+    table = output_doc.tables[tableNo] if isinstance(tableNo, int) else tableNo
     table.style = "Table Grid"
     
     # Define desired widths: 4 inches for the first, 2 inches for the second, 2 inches for the third, and 4 inches for the last
@@ -471,13 +623,175 @@ def format_table_with_picture(output_doc, tableNo, imagePath):
     
     try:
         # Attempt to add the picture to the paragraph
-        run.add_picture(imagePath, width=Cm(4.5), height=Cm(4.5))
+        shape = run.add_picture(imagePath, width=Cm(4.5), height=Cm(4.5))
+        if name is not None:
+            shape._inline.graphic.graphicData.pic.nvPicPr.cNvPr.name = name
     except Exception as e:
-        print(f"Error adding image {imagePath}: {e}")
+        log.warning(f"Error adding image {name or imagePath}: {e}")
+def append_block(output_doc, element):
+    """
+    Append a paragraph or table element at the end of the body. The body always ends with
+    its section properties, so the append position is found from the end in O(1) instead of
+    building output_doc.paragraphs for every insertion.
+    """
+    body = output_doc.element.body
+    last = body[-1] if len(body) else None
+    if last is not None and last.tag == qn('w:sectPr'):
+        last.addprevious(element)
+    else:
+        body.append(element)
+    return element
+
+
 def copy_table(output_doc, table):
-    p = output_doc.paragraphs[-1]
+    new_tbl = append_block(output_doc, deepcopy(table._tbl))
+    return Table(new_tbl, output_doc._body)
+
+class FragmentCache:
+    """
+    LRU cache of fully formatted table XML keyed by a hash of the source table, so tables
+    that repeat across offers (the datasheets) are spliced in already styled. Fragments are
+    also written to `folder`, one file each, and shared by all worker processes.
+    """
+    # Bump when the table styling changes so old fragments are not reused
+    VERSION = b'1'
+
+    def __init__(self, folder=None, max_entries=256, max_files=5000):
+        self.folder = folder
+        self.max_entries = max_entries
+        self.max_files = max_files
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+
+    def key(self, tbl):
+        # Exclusive canonical form: namespace declarations the table does not use don't count
+        return hashlib.sha1(self.VERSION + etree.tostring(tbl, method='c14n', exclusive=True)).hexdigest()
+
+    def get(self, key):
+        xml = self.entries.get(key)
+        if xml is None and self.folder:
+            try:
+                with open(os.path.join(self.folder, key + '.xml'), 'rb') as fp:
+                    xml = fp.read()
+            except OSError:
+                xml = None
+            if xml is not None:
+                self.remember(key, xml)
+        if xml is None:
+            self.misses += 1
+            metrics.inc('docgen_cache_requests_total', (('cache', 'fragment'), ('result', 'miss')))
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        metrics.inc('docgen_cache_requests_total', (('cache', 'fragment'), ('result', 'hit')))
+        return xml
+
+    def put(self, key, xml):
+        self.remember(key, xml)
+        if not self.folder:
+            return
+        path = os.path.join(self.folder, key + '.xml')
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            with open(tmp_path, 'wb') as fp:
+                fp.write(xml)
+            os.replace(tmp_path, path)
+        except OSError:
+            logging.error(f"Failed to store table fragment {key}", exc_info=True)
+            return
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.prune()
+
+    def remember(self, key, xml):
+        self.entries[key] = xml
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def prune(self):
+        """
+        Remove the least recently written fragment files above max_files.
+        """
+        with os.scandir(self.folder) as entries:
+            files = [(entry.stat().st_mtime, entry.path) for entry in entries if entry.name.endswith('.xml')]
+        files.sort()
+        for _, path in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+fragment_caches = {}
+
+
+def get_fragment_cache():
+    if FRAGMENT_CACHE_DIR is None:
+        return None
+    cache = fragment_caches.get(FRAGMENT_CACHE_DIR)
+    if cache is None:
+        cache = fragment_caches[FRAGMENT_CACHE_DIR] = FragmentCache(FRAGMENT_CACHE_DIR)
+    return cache
+
+
+def style_table(table):
+    """
+    Apply to one table what build_offer applies to all copied tables at the end.
+    """
+    set_table_font(table)
+    format_single_table(table, TABLE_WIDTHS[3])
+    darken_table_first_row(table)
+
+
+def fragment_cacheable(tbl):
+    # Widths must not depend on the previous table, and there must be no relationship
+    # references (pictures, links) that would point into another document
+    if tbl.xpath('.//@r:embed | .//@r:id | .//@r:link'):
+        return False
+    return all(len(tr.tc_lst) in TABLE_WIDTHS and not tr.xpath('./w:tc/w:tcPr/w:gridSpan | ./w:tc/w:tcPr/w:vMerge')
+               for tr in tbl.tr_lst)
+
+
+W14_NS = '{http://schemas.microsoft.com/office/word/2010/wordml}'
+
+
+def strip_revision_ids(element):
+    """
+    Remove the editing-session ids (w:rsid*, w14:paraId, w14:textId) Word stamps on every
+    row and paragraph; they differ between reports with the same content.
+    """
+    for el in element.iter():
+        for name in list(el.attrib):
+            if name.startswith(W_NS + 'rsid') or name in (W14_NS + 'paraId', W14_NS + 'textId'):
+                del el.attrib[name]
+
+
+def copy_styled_table(output_doc, table, preformatted):
+    """
+    Copy a raw table that is formatted through the fragment cache. The new table is added to
+    `preformatted` so the final formatting passes leave it alone.
+    """
+    cache = get_fragment_cache()
+    if cache is None or not fragment_cacheable(table._tbl):
+        return copy_table(output_doc, table)
     new_tbl = deepcopy(table._tbl)
-    p._p.addnext(new_tbl)
+    strip_revision_ids(new_tbl)
+    key = cache.key(new_tbl)
+    xml = cache.get(key)
+    if xml is None:
+        new_table = Table(append_block(output_doc, new_tbl), output_doc._body)
+        style_table(new_table)
+        cache.put(key, etree.tostring(new_tbl))
+    else:
+        new_table = Table(append_block(output_doc, parse_xml(xml)), output_doc._body)
+    preformatted.add(new_table._tbl)
+    return new_table
+
 
 def title_run(r):
     r.font.size = Pt(22)
@@ -485,11 +799,17 @@ def title_run(r):
     r.font.color.rgb = RGBColor(250, 168, 32)
     r.font.name = "Barlow (Heading)"
     
-def replace_variables(output_doc, raw_doc):
+def extract_text_boxes(raw_doc):
+    """
+    Read the offer number and the address lines from the text boxes of the raw document.
+
+    Returns:
+        tuple: The "Angebotsnr." text and the list of parsed address lines.
+    """
     txbx = raw_doc.inline_shapes._body.xpath('//w:txbxContent')
     address_lines = []
     id = ''
-    
+
     # Extract information from text boxes
     for tx_idx, tx in enumerate(txbx):
         children = tx.getchildren()
@@ -498,190 +818,1084 @@ def replace_variables(output_doc, raw_doc):
                 if child.text.startswith("Angebotsnr."):
                     id = child.text
                 else:
+                    # Parse and add the address lines
                     address_lines.extend(parse_address(child.text))
-    
-    # Extract module, kw, and date
-    module = raw_doc.tables[1].cell(4, 1).paragraphs[0].text
-    print(module)
-    kw = raw_doc.tables[1].cell(2, 1).paragraphs[0].text
-    date = raw_doc.paragraphs[0].text
-    
-    # Add additional address information
-    additional_address = raw_doc.tables[0].cell(1, 0).paragraphs[0].text
-    address_lines.extend(parse_address(additional_address))
-    
-    try:
-        additional_address_line = raw_doc.tables[0].cell(1, 0).paragraphs[1].text
-        address_lines.extend(parse_address(additional_address_line))
-    except IndexError:
-        pass
+    return id, address_lines
 
-    # Use a set to track unique address lines
-    unique_address_lines = list(dict.fromkeys(address_lines))  # Preserve order while removing duplicates
 
-    # Remove address lines from the first page content if they are not needed
-    # Assume paragraph indices 5-7 hold the address, adjust if necessary
-    paragraphs_to_remove = [5, 6, 7]
-    for i in sorted(paragraphs_to_remove, reverse=True):
-        if i < len(output_doc.paragraphs):
-            output_doc.paragraphs[i].clear()
+W_NS = '{http://schemas.openxmlformats.org/wordprocessingml/2006/main}'
 
-    i = 0
-    for p in output_doc.paragraphs:
-        text = p.text
-        if i == 2:
-            p.text = ""
-            r = p.add_run(text.replace("0.00", kw))
-            title_run(r)
-        if i == 3:
-            p.text = ""
-            r = p.add_run(text.replace("0", module))
-            title_run(r)
-        elif i == 5:
-            p.text = ""
-            if len(unique_address_lines) > 0:
-                r = p.add_run(unique_address_lines[0])
-                print(unique_address_lines[0])
-                title_run(r)
-        elif i == 6:
-            p.text = ""
-            if len(unique_address_lines) > 2:
-                r = p.add_run(unique_address_lines[2])
-                print(unique_address_lines[2])
-                title_run(r)
-        elif i == 7:
-            p.text = ""
-            if len(unique_address_lines) > 1:
-                r = p.add_run(unique_address_lines[1])
-                print(unique_address_lines[1])
-                title_run(r)
-        elif i == 8:
-            p.text = ""
-            r = p.add_run(date)
-            title_run(r)
-        i += 1
+# Raw tables read by extract_offer_metadata. The module table is tables[5] of the output,
+# which drops the address table, so it is tables[6] of the raw report.
+META_ADDRESS_TABLE = 0
+META_SYSTEM_TABLE = 1
+META_MODULE_TABLE = 6
 
-def set_font(paragraph, font_name):
-    for run in paragraph.runs:
-        run.font.name = font_name
-        run._element.rPr.rFonts.set(qn('w:ascii'), font_name)
-        run._element.rPr.rFonts.set(qn('w:eastAsia'), font_name)
-        run._element.rPr.rFonts.set(qn('w:hAnsi'), font_name)
-        run._element.rPr.rFonts.set(qn('w:cs'), font_name)
-def parse_address(address_text):
-    """
-    Parse the address into a list of lines based on whether it contains a comma.
-    """
-    if ',' in address_text:
-        # Compact format with street and city in one line
-        return [line.strip() for line in address_text.split(',')]
-    else:
-        # Standard format with multiple lines
-        return address_text.splitlines()
 
-def parse_address(address_text):
+def xml_paragraph_text(p):
     """
-    Parse the address into a list of lines. The last part of the address should keep the city and country together.
+    Text of a w:p element, read the same way as python-docx's paragraph.text.
     """
-    if ',' in address_text:
-        # Split address based on commas
-        parts = [part.strip() for part in address_text.split(',')]
-        
-        # Handle case where the last part might be the country
-        if len(parts) > 2:
-            # Combine the city and country into a single line
-            combined = ', '.join(parts[-2:])
-            return parts[:-2] + [combined]
-        else:
-            return parts
-    else:
-        # Standard format with multiple lines
-        return address_text.splitlines()
+    text = []
+    for run in p:
+        if run.tag == W_NS + 'hyperlink':
+            text.append(xml_paragraph_text(run))
+            continue
+        if run.tag != W_NS + 'r':
+            continue
+        for child in run:
+            if child.tag == W_NS + 't':
+                text.append(child.text or '')
+            elif child.tag in (W_NS + 'tab', W_NS + 'ptab'):
+                text.append('\t')
+            elif child.tag in (W_NS + 'br', W_NS + 'cr'):
+                text.append('\n')
+            elif child.tag == W_NS + 'noBreakHyphen':
+                text.append('-')
+    return ''.join(text)
 
-def prepare_header(output_doc, raw_doc):
-    txbx = raw_doc.inline_shapes._body.xpath('//w:txbxContent')
-    address_lines = []
-    date = ''
-    id = ''
 
-    # Extract information from text boxes
-    for tx_idx, tx in enumerate(txbx):
-        children = tx.getchildren()
-        for child_idx, child in enumerate(children):
-            if child.text:
-                if child.text.startswith("Angebotsnr."):
-                    id = child.text
+def xml_table_grid(tbl):
+    """
+    Cells of a w:tbl element as a grid of w:tc elements, merged cells repeated the way
+    python-docx's table.cell(row, col) resolves them.
+    """
+    grid = []
+    for tr in tbl.iterfind(W_NS + 'tr'):
+        row = []
+        for tc in tr.iterfind(W_NS + 'tc'):
+            tcPr = tc.find(W_NS + 'tcPr')
+            span, v_merge = 1, None
+            if tcPr is not None:
+                grid_span = tcPr.find(W_NS + 'gridSpan')
+                if grid_span is not None:
+                    span = int(grid_span.get(W_NS + 'val', 1))
+                merge = tcPr.find(W_NS + 'vMerge')
+                if merge is not None:
+                    v_merge = merge.get(W_NS + 'val', 'continue')
+            for _ in range(span):
+                col = len(row)
+                if v_merge == 'continue' and grid and col < len(grid[-1]):
+                    row.append(grid[-1][col])
                 else:
-                    # Parse and add the address lines
-                    address_lines.extend(parse_address(child.text))
+                    row.append(tc)
+        grid.append(row)
+    return grid
 
-    # Extract date from paragraphs
-    if raw_doc.paragraphs:
-        date = raw_doc.paragraphs[0].text
 
-    # Extract additional address information from tables if available
+def xml_cell_paragraphs(grid, row, col):
     try:
-        additional_address = raw_doc.tables[0].cell(1, 0).paragraphs[0].text
-        address_lines.extend(parse_address(additional_address))
+        tc = grid[row][col]
     except IndexError:
-        pass
+        return []
+    return [xml_paragraph_text(p) for p in tc.iterfind(W_NS + 'p')]
 
-    # Prepare the header section
-    section = output_doc.sections[0]
-    header = section.header
-    section.different_first_page_header_footer = True
-    t = header.add_table(2, 2, Inches(24))
 
-    # Cell (0, 0) content
-    cell_00 = t.cell(0, 0)
-    cell_00.text = ''
-    cell_00.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
-    p = cell_00.paragraphs[0]
+def stream_body(archive, part, table_numbers):
+    """
+    Stream the body of a document part and collect what the metadata extractors need.
+    Parsing stops after the highest table number asked for.
 
-    # Add parsed address lines without duplications and empty lines
-    unique_addresses = set()
-    for line in address_lines:
-        line = line.strip()  # Remove leading/trailing whitespace
-        if line and line not in unique_addresses:
-            r = p.add_run(line)
-            r.font.size = Pt(8)
-            r.add_break()  # Only add a break if there's another line to follow
-            unique_addresses.add(line)
-    set_font(p, "Barlow")
+    Returns:
+        tuple: Text of the first body paragraph, the texts of all text box paragraphs seen
+        and a {table number: grid} dict (see xml_table_grid).
+    """
+    first_paragraph = None
+    text_box_lines = []
+    grids = {}
+    depth = 0
+    table_no = 0
+    with archive.open(part) as stream:
+        for event, elem in ElementTree.iterparse(stream, events=('start', 'end')):
+            if event == 'start':
+                depth += 1
+                continue
+            depth -= 1
+            if elem.tag == W_NS + 'txbxContent':
+                for child in elem.iterfind(W_NS + 'p'):
+                    text = xml_paragraph_text(child)
+                    if text:
+                        text_box_lines.append(text)
+            # Direct children of w:body sit at depth 2 (document, body)
+            if depth != 2:
+                continue
+            if elem.tag == W_NS + 'p' and first_paragraph is None:
+                first_paragraph = xml_paragraph_text(elem)
+            elif elem.tag == W_NS + 'tbl':
+                if table_no in table_numbers:
+                    grids[table_no] = xml_table_grid(elem)
+                table_no += 1
+                if table_no > max(table_numbers):
+                    break
+            elem.clear()
+    return first_paragraph, text_box_lines, grids
 
-    # Remove the last line break if it exists
-    if p.runs and p.runs[-1].text.endswith('\n'):
-        p.runs[-1].text = p.runs[-1].text.rstrip('\n')
 
-    # Cell (1, 0) content
-    cell_10 = t.cell(1, 0)
-    cell_10.text = ''
-    cell_10.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
-    p = cell_10.paragraphs[0]
-    r11 = p.add_run(date)
-    r11.font.size = Pt(8)
-    r11.add_break()
+def unique_lines(lines):
+    unique = []
+    for line in lines:
+        line = line.strip()
+        if line and line not in unique:
+            unique.append(line)
+    return unique
 
-    # Split `id` and handle cases where it doesn't contain a space
-    id_parts = id.split(" ")
-    if len(id_parts) > 1:
-        r21 = p.add_run(id_parts[1])
-    else:
-        r21 = p.add_run(id)  # Fallback: use the entire `id` string
-    r21.font.size = Pt(8)
-    set_font(p, "Barlow")
 
-    # Cell (0, 1) content
-    cell_01 = t.cell(0, 1)
-    cell_01.text = ''
-    cell_01.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    p = cell_01.paragraphs[0]
-    r21 = p.add_run()
-    r21.add_picture("assets/template_images/header.png", Cm(1.5), Cm(1.25))
+def extract_offer_metadata(path):
+    """
+    Read the offer metadata straight from the main document part of a raw report, without
+    python-docx and without running the conversion.
 
-    # Cell (1, 1) content
-    cell_11 = t.cell(1, 1)
-    cell_11.text = ''
+    The XML is parsed as a stream and parsing stops after the last table needed, so only
+    the first pages of the report are read.
+
+    Args:
+        path (str or bytes): Path of the raw report, or its content.
+
+    Returns:
+        dict: offer_number, address (list of lines), kwp, module_count, module and date.
+    """
+    source = BytesIO(path) if isinstance(path, (bytes, bytearray)) else path
+    with zipfile.ZipFile(source) as archive:
+        part = main_document_part(archive)
+        date, text_box_lines, grids = stream_body(
+            archive, part, (META_ADDRESS_TABLE, META_SYSTEM_TABLE, META_MODULE_TABLE))
+
+    offer_id = ''
+    address_lines = []
+    for text in text_box_lines:
+        if text.startswith("Angebotsnr."):
+            offer_id = text
+        else:
+            address_lines.extend(parse_address(text))
+    address_grid = grids.get(META_ADDRESS_TABLE, [])
+    for text in xml_cell_paragraphs(address_grid, 1, 0)[:2]:
+        address_lines.extend(parse_address(text))
+
+    system_grid = grids.get(META_SYSTEM_TABLE, [])
+    module_grid = grids.get(META_MODULE_TABLE, [])
+    kwp = (xml_cell_paragraphs(system_grid, 2, 1) or [None])[0]
+    module_count = (xml_cell_paragraphs(system_grid, 4, 1) or [None])[0]
+    module_cell = '\n'.join(xml_cell_paragraphs(module_grid, 1, 1)).strip()
+    id_parts = offer_id.split(" ")
+    return {
+        'offer_number': id_parts[1] if len(id_parts) > 1 else offer_id,
+        'address': unique_lines(address_lines),
+        'kwp': kwp,
+        'module_count': module_count,
+        'module': clean_module_text(module_cell) if module_cell else None,
+        'date': date,
+    }
+
+
+def extract_output_metadata(path):
+    """
+    Same fields as extract_offer_metadata, read back from a generated offer: the address,
+    date and offer number from the header table, the rest from the copied tables.
+    """
+    with zipfile.ZipFile(path) as archive:
+        part = main_document_part(archive)
+        _, _, grids = stream_body(archive, part, (META_SYSTEM_TABLE - 1, META_MODULE_TABLE - 1))
+        header_grid = []
+        for name in sorted(archive.namelist()):
+            if name.startswith('word/header') and name.endswith('.xml'):
+                tbl = ElementTree.fromstring(archive.read(name)).find('.//' + W_NS + 'tbl')
+                if tbl is not None:
+                    header_grid = xml_table_grid(tbl)
+                    break
+
+    address = unique_lines('\n'.join(xml_cell_paragraphs(header_grid, 0, 0)).splitlines())
+    date_and_id = unique_lines('\n'.join(xml_cell_paragraphs(header_grid, 1, 0)).splitlines())
+    system_grid = grids.get(META_SYSTEM_TABLE - 1, [])
+    module_grid = grids.get(META_MODULE_TABLE - 1, [])
+    module_cell = '\n'.join(xml_cell_paragraphs(module_grid, 1, 1)).strip()
+    return {
+        'offer_number': date_and_id[1] if len(date_and_id) > 1 else '',
+        'address': address,
+        'kwp': (xml_cell_paragraphs(system_grid, 2, 1) or [None])[0],
+        'module_count': (xml_cell_paragraphs(system_grid, 4, 1) or [None])[0],
+        'module': clean_module_text(module_cell) if module_cell else None,
+        'date': date_and_id[0] if date_and_id else None,
+    }
+
+
+OFFER_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS offers (
+    id INTEGER PRIMARY KEY,
+    offer_number TEXT,
+    address TEXT,
+    kwp TEXT,
+    module_count TEXT,
+    module TEXT,
+    date TEXT,
+    input_path TEXT,
+    output_path TEXT UNIQUE,
+    output_mtime REAL,
+    content_hash TEXT,
+    processing_time REAL,
+    indexed_at REAL
+);
+CREATE INDEX IF NOT EXISTS offers_offer_number ON offers(offer_number);
+CREATE INDEX IF NOT EXISTS offers_content_hash ON offers(content_hash);
+"""
+
+# Full text search on address and module, kept in sync by triggers
+OFFER_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS offers_fts USING fts5(address, module, content='offers', content_rowid='id');
+CREATE TRIGGER IF NOT EXISTS offers_ai AFTER INSERT ON offers BEGIN
+    INSERT INTO offers_fts(rowid, address, module) VALUES (new.id, new.address, new.module);
+END;
+CREATE TRIGGER IF NOT EXISTS offers_ad AFTER DELETE ON offers BEGIN
+    INSERT INTO offers_fts(offers_fts, rowid, address, module) VALUES ('delete', old.id, old.address, old.module);
+END;
+CREATE TRIGGER IF NOT EXISTS offers_au AFTER UPDATE ON offers BEGIN
+    INSERT INTO offers_fts(offers_fts, rowid, address, module) VALUES ('delete', old.id, old.address, old.module);
+    INSERT INTO offers_fts(rowid, address, module) VALUES (new.id, new.address, new.module);
+END;
+"""
+
+
+def open_index(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(OFFER_INDEX_SCHEMA)
+    try:
+        conn.executescript(OFFER_FTS_SCHEMA)
+    except sqlite3.OperationalError:
+        # SQLite built without FTS5, search_offers falls back to LIKE
+        pass
+    return conn
+
+
+def upsert_offer(conn, metadata, input_path, output_path, content_hash=None, processing_time=None):
+    output_mtime = os.path.getmtime(output_path) if os.path.exists(output_path) else None
+    conn.execute("""
+        INSERT INTO offers (offer_number, address, kwp, module_count, module, date, input_path,
+                            output_path, output_mtime, content_hash, processing_time, indexed_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(output_path) DO UPDATE SET
+            offer_number=excluded.offer_number, address=excluded.address, kwp=excluded.kwp,
+            module_count=excluded.module_count, module=excluded.module, date=excluded.date,
+            input_path=COALESCE(excluded.input_path, offers.input_path),
+            output_mtime=excluded.output_mtime,
+            content_hash=COALESCE(excluded.content_hash, offers.content_hash),
+            processing_time=COALESCE(excluded.processing_time, offers.processing_time),
+            indexed_at=excluded.indexed_at
+    """, (metadata.get('offer_number'), '\n'.join(metadata.get('address') or []), metadata.get('kwp'),
+          metadata.get('module_count'), metadata.get('module'), metadata.get('date'), input_path,
+          os.path.abspath(output_path), output_mtime, content_hash, processing_time, time.time()))
+
+
+def record_offer(metadata, input_path, output_path, content_hash=None, processing_time=None):
+    """
+    Add one processed job to INDEX_DB. Indexing problems are logged, never fail the job.
+    """
+    if not INDEX_DB:
+        return
+    try:
+        if metadata is None:
+            metadata = extract_output_metadata(output_path)
+        conn = open_index(INDEX_DB)
+        try:
+            with conn:
+                upsert_offer(conn, metadata, input_path, output_path, content_hash, processing_time)
+        finally:
+            conn.close()
+    except Exception:
+        logging.error(f"Failed to index {output_path}", exc_info=True)
+
+
+def safe_output_metadata(path):
+    try:
+        return extract_output_metadata(path)
+    except Exception:
+        logging.error(f"Failed to read metadata of {path}", exc_info=True)
+        return None
+
+
+def rebuild_index(db_path, output_folder, workers=None):
+    """
+    Bring the index up to date with the offers in output_folder. Offers whose file did not
+    change since they were indexed are skipped, the others are read in parallel worker
+    processes, and rows of deleted offers are removed.
+
+    Returns:
+        int: Number of offers (re)indexed.
+    """
+    conn = open_index(db_path)
+    try:
+        known = {row['output_path']: row['output_mtime']
+                 for row in conn.execute('SELECT output_path, output_mtime FROM offers')}
+        present = set()
+        todo = []
+        with os.scandir(output_folder) as entries:
+            for entry in entries:
+                if not entry.is_file() or not entry.name.endswith('-output.docx') or entry.name.startswith('~$'):
+                    continue
+                path = os.path.abspath(entry.path)
+                present.add(path)
+                if known.get(path) != entry.stat().st_mtime:
+                    todo.append(path)
+
+        folder = os.path.abspath(output_folder)
+        gone = [path for path in known if os.path.dirname(path) == folder and path not in present]
+        results = []
+        if todo:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(safe_output_metadata, todo, chunksize=16))
+        with conn:
+            for path, metadata in zip(todo, results):
+                if metadata is not None:
+                    upsert_offer(conn, metadata, None, path)
+            conn.executemany('DELETE FROM offers WHERE output_path = ?', [(path,) for path in gone])
+        return sum(1 for metadata in results if metadata is not None)
+    finally:
+        conn.close()
+
+
+def search_offers(db_path, query, limit=50):
+    """
+    Find offers by address or module, e.g. search_offers(INDEX_DB, 'Birsfelden').
+
+    Returns:
+        list: One dict per matching offer, best matches first.
+    """
+    conn = open_index(db_path)
+    try:
+        try:
+            # Every word is matched as a quoted prefix so user input cannot break the FTS syntax
+            terms = ' '.join('"' + word.replace('"', '""') + '"*' for word in query.split())
+            rows = conn.execute("""
+                SELECT offers.* FROM offers_fts JOIN offers ON offers.id = offers_fts.rowid
+                WHERE offers_fts MATCH ? ORDER BY rank LIMIT ?
+            """, (terms, limit)).fetchall()
+        except sqlite3.OperationalError:
+            pattern = f'%{query}%'
+            rows = conn.execute('SELECT * FROM offers WHERE address LIKE ? OR module LIKE ? LIMIT ?',
+                                (pattern, pattern, limit)).fetchall()
+        return [dict(row) for row in rows]
+    finally:
+        conn.close()
+
+
+# ID of the job the current thread or task works on, put on every log record
+current_job = ContextVar('current_job', default='-')
+
+
+def new_job_id(file_name):
+    # The random suffix tells apart jobs of the same report started in the same second
+    return f"{os.path.splitext(file_name)[0]}-{time.strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+
+
+class JobFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'job'):
+            record.job = current_job.get()
+        return True
+
+
+class JobQueueHandler(QueueHandler):
+    # Formatting is left to the listener thread, off the render path
+    def prepare(self, record):
+        return record
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Append the records of every job to `folder`/<job id>.log, one JSON object per line.
+    The files of the most recent jobs are kept open. Files older than `max_age` seconds are
+    removed on start and then every 100 new files.
+    """
+    def __init__(self, folder, max_open=8, max_age=JOB_LOG_MAX_AGE):
+        super().__init__()
+        self.folder = folder
+        self.max_open = max_open
+        self.max_age = max_age
+        self.files = OrderedDict()
+        self.created = 0
+        os.makedirs(folder, exist_ok=True)
+        self.prune()
+
+    def prune(self):
+        now = time.time()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith('.log') and now - entry.stat().st_mtime > self.max_age:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+
+    def emit(self, record):
+        if record.job == '-':
+            return
+        try:
+            entry = {
+                'time': record.created,
+                'level': record.levelname,
+                'job': record.job,
+                'where': f"{record.funcName}:{record.lineno}",
+                'message': record.getMessage(),
+            }
+            if record.exc_info:
+                entry['exception'] = logging.Formatter().formatException(record.exc_info)
+            fp = self.files.get(record.job)
+            if fp is None:
+                fp = self.files[record.job] = open(os.path.join(self.folder, f"{record.job}.log"), 'a', encoding='utf-8')
+                if len(self.files) > self.max_open:
+                    self.files.popitem(last=False)[1].close()
+                self.created += 1
+                if self.created % 100 == 0:
+                    self.prune()
+            self.files.move_to_end(record.job)
+            fp.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            fp.flush()
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        for fp in self.files.values():
+            fp.close()
+        self.files.clear()
+        super().close()
+
+
+class CollectingHandler(logging.Handler):
+    """
+    Keep the records of a render process until they are sent back with the job (drain).
+    """
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        # Made picklable: the message is rendered and the traceback turned into text
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+    def drain(self):
+        records, self.records = self.records, []
+        return records
+
+
+def replay_records(records):
+    """
+    Log the records collected in another process (CollectingHandler) here.
+    """
+    for record in records:
+        logger = logging.getLogger(record.name)
+        if logger.isEnabledFor(record.levelno):
+            logger.handle(record)
+
+
+log_listener = None
+
+
+def setup_logging():
+    """
+    Send all logging through a queue to a background thread that writes the console
+    (LOG_LEVEL), error_log.txt (errors) and the per-job log files (JOB_LOG_FOLDER), so a
+    job never waits for log output. Every record carries the ID of its job.
+    """
+    global log_listener
+    if log_listener is not None:
+        return
+    formatter = logging.Formatter('%(asctime)s %(levelname)s [%(job)s] %(message)s')
+    console = logging.StreamHandler()
+    console.setLevel(LOG_LEVEL)
+    errors = logging.FileHandler('error_log.txt', encoding='utf-8')
+    errors.setLevel(logging.ERROR)
+    handlers = [console, errors]
+    if JOB_LOG_FOLDER:
+        handlers.append(JobLogHandler(JOB_LOG_FOLDER))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = Queue()
+    queue_handler = JobQueueHandler(records)
+    queue_handler.addFilter(JobFilter())
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+        handler.close()
+    root.addHandler(queue_handler)
+    root.setLevel(logging.INFO)
+    log.setLevel(logging.DEBUG if JOB_LOG_FOLDER else LOG_LEVEL)
+    log_listener = QueueListener(records, *handlers, respect_handler_level=True)
+    log_listener.start()
+    atexit.register(log_listener.stop)
+
+
+METRIC_HELP = {
+    'docgen_jobs_total': "Jobs finished, by outcome (done, failed, rejected, quarantined).",
+    'docgen_queue_depth': "Reports waiting in the job queue.",
+    'docgen_job_wait_seconds': "Time from queueing a report to starting its job.",
+    'docgen_job_seconds': "Time from starting a job to its output being written.",
+    'docgen_stage_seconds': "Duration of the job stages (read, parse, render, write).",
+    'docgen_render_workers': "Render processes of the pipeline.",
+    'docgen_render_workers_busy': "Render processes working on a job.",
+    'docgen_render_busy_seconds_total': "Time the render processes spent on jobs; its rate over docgen_render_workers is the utilization.",
+    'docgen_cache_requests_total': "Cache lookups, by cache (skeleton, fragment, revision) and result (hit, miss).",
+}
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms of the service, served in the Prometheus text format.
+    Render processes collect their own and send them back with every job (drain, merge).
+    Gauges may be callables, read when the metrics are rendered.
+    """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """
+        Drop everything collected, e.g. in a process forked from the service. The lock is
+        new too: another thread may have held it at the fork.
+        """
+        self.lock = Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def inc(self, name, labels=(), value=1):
+        with self.lock:
+            self.counters[name, labels] = self.counters.get((name, labels), 0) + value
+
+    def set(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[name, labels] = value
+
+    def add(self, name, value, labels=()):
+        with self.lock:
+            self.gauges[name, labels] = self.gauges.get((name, labels), 0) + value
+
+    def observe(self, name, value, labels=()):
+        with self.lock:
+            counts = self.histograms.setdefault((name, labels), [0] * (len(self.BUCKETS) + 1) + [0.0])
+            counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+            counts[-1] += value
+
+    def drain(self):
+        """
+        Take the counters and histograms collected since the last call.
+        """
+        with self.lock:
+            collected = (self.counters, self.histograms)
+            self.counters, self.histograms = {}, {}
+        return collected
+
+    def merge(self, collected):
+        counters, histograms = collected
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, counts in histograms.items():
+                total = self.histograms.setdefault(key, [0] * len(counts))
+                for i, value in enumerate(counts):
+                    total[i] += value
+
+    def render(self):
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: list(counts) for key, counts in self.histograms.items()}
+        samples = {}
+        for (name, labels), value in counters.items():
+            samples.setdefault((name, 'counter'), []).append((name, labels, value))
+        for (name, labels), value in gauges.items():
+            samples.setdefault((name, 'gauge'), []).append((name, labels, value() if callable(value) else value))
+        for (name, labels), counts in histograms.items():
+            series = samples.setdefault((name, 'histogram'), [])
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS + ('+Inf',), counts):
+                cumulative += count
+                series.append((f'{name}_bucket', labels + (('le', str(bound)),), cumulative))
+            series.append((f'{name}_sum', labels, counts[-1]))
+            series.append((f'{name}_count', labels, cumulative))
+
+        lines = []
+        for (name, kind), series in sorted(samples.items()):
+            if name in METRIC_HELP:
+                lines.append(f"# HELP {name} {METRIC_HELP[name]}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != 'histogram':
+                series.sort(key=lambda s: s[1])
+            for sample, labels, value in series:
+                label_text = ','.join(f'{key}="{value}"' for key, value in labels)
+                lines.append(f"{sample}{{{label_text}}} {value}" if labels else f"{sample} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.observe('docgen_stage_seconds', time.perf_counter() - started, (('stage', stage),))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scraped every few seconds, keep it off the console
+        pass
+
+
+def start_metrics_server(port):
+    """
+    Serve the metrics on 127.0.0.1:`port` from a daemon thread. A busy port is logged, not fatal.
+    """
+    try:
+        server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+    except OSError:
+        logging.error(f"Failed to start the metrics endpoint on port {port}", exc_info=True)
+        return None
+    Thread(target=server.serve_forever, daemon=True).start()
+    log.info(f"Metrics on http://127.0.0.1:{port}/metrics")
+    return server
+
+
+class RetryScheduler:
+    """
+    Runs calls later from a timer thread. File operations that fail on a locked file are
+    retried there with exponential backoff (run), so the worker that hit the lock goes on
+    with the next job instead of sleeping.
+    """
+    def __init__(self):
+        self.pending = []
+        self.order = itertools.count()
+        self.condition = Condition()
+        self.thread = None
+
+    def call_later(self, delay, fn, *args):
+        # Run in the context of the caller, so the log records keep their job ID
+        context = copy_context()
+        with self.condition:
+            heapq.heappush(self.pending, (time.monotonic() + delay, next(self.order), context, fn, args))
+            self.condition.notify()
+            if self.thread is None:
+                self.thread = Thread(target=self.work, daemon=True)
+                self.thread.start()
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.pending[0][0] > time.monotonic():
+                    self.condition.wait(self.pending[0][0] - time.monotonic() if self.pending else None)
+                _, _, context, fn, args = heapq.heappop(self.pending)
+            try:
+                context.run(fn, *args)
+            except Exception:
+                logging.error(f"Scheduled call {fn.__name__} failed", exc_info=True)
+
+    def run(self, description, fn, *args, on_success=None, on_failure=None,
+            attempts=None, delay=None, retry_on=(PermissionError,)):
+        """
+        Call fn(*args) now. If it fails with `retry_on`, call it again after `delay` seconds
+        (RETRY_DELAY), doubling the delay, until it succeeds or `attempts` (RETRY_ATTEMPTS)
+        calls failed. `on_success()` or
+        `on_failure(error)` is called at the end, from the timer thread after a retry.
+        Other exceptions of the first call are raised; later ones count as the final failure.
+        Exceptions of the callbacks are logged, they do not make the call fail.
+
+        Returns:
+            bool: True if the first call succeeded.
+        """
+        def finish(callback, *callback_args):
+            if callback is None:
+                return
+            try:
+                callback(*callback_args)
+            except Exception:
+                logging.error(f"Failed to finish after the call to {description}", exc_info=True)
+
+        def attempt(remaining, delay):
+            try:
+                fn(*args)
+            except retry_on as e:
+                if remaining > 1:
+                    log.warning(f"Failed to {description} ({e}), retrying in {delay} s")
+                    self.call_later(delay, attempt, remaining - 1, delay * 2)
+                    return False
+                logging.error(f"Failed to {description} after {attempts} attempts", exc_info=True)
+                finish(on_failure, e)
+                return False
+            except Exception as e:
+                if remaining == attempts:
+                    raise
+                logging.error(f"Failed to {description}", exc_info=True)
+                finish(on_failure, e)
+                return False
+            finish(on_success)
+            return True
+        attempts = RETRY_ATTEMPTS if attempts is None else attempts
+        return attempt(attempts, RETRY_DELAY if delay is None else delay)
+
+
+retries = RetryScheduler()
+
+
+JOURNAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    path TEXT PRIMARY KEY,
+    file_name TEXT,
+    size INTEGER,
+    mtime REAL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    updated_at REAL
+);
+"""
+
+# Finished jobs are dropped from the journal after this many seconds
+JOURNAL_MAX_AGE = 30 * 24 * 3600
+
+# Journal keys of the jobs queued or being processed; a second event for them is ignored
+active_jobs = set()
+active_jobs_lock = Lock()
+# When the active jobs were queued, for docgen_job_wait_seconds
+enqueued_at = {}
+
+
+def open_journal(db_path):
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(JOURNAL_SCHEMA)
+    return conn
+
+
+def journal_key(path):
+    return os.path.normcase(os.path.abspath(path))
+
+
+def journal_write(sql, params):
+    """
+    Run one statement on JOURNAL_DB. Journal problems are logged, never fail the job.
+    """
+    if not JOURNAL_DB:
+        return
+    try:
+        conn = open_journal(JOURNAL_DB)
+        try:
+            with conn:
+                conn.execute(sql, params)
+        finally:
+            conn.close()
+    except Exception:
+        logging.error("Failed to update the job journal", exc_info=True)
+
+
+def enqueue_job(queue, file_name, src_path):
+    """
+    Put a report on the job queue unless it is already queued or being processed,
+    and journal it as queued. The attempts of an unchanged report are kept.
+
+    Returns:
+        bool: True if the report was queued.
+    """
+    key = journal_key(src_path)
+    with active_jobs_lock:
+        if key in active_jobs:
+            return False
+        active_jobs.add(key)
+        enqueued_at[key] = time.time()
+    try:
+        stat = os.stat(src_path)
+        size, mtime = stat.st_size, stat.st_mtime
+    except OSError:
+        size = mtime = None
+    journal_write("""
+        INSERT INTO jobs (path, file_name, size, mtime, state, attempts, error, updated_at)
+        VALUES (?, ?, ?, ?, 'queued', 0, NULL, ?)
+        ON CONFLICT(path) DO UPDATE SET
+            attempts = CASE WHEN size IS excluded.size AND mtime IS excluded.mtime THEN attempts ELSE 0 END,
+            file_name = excluded.file_name, size = excluded.size, mtime = excluded.mtime,
+            state = 'queued', error = NULL, updated_at = excluded.updated_at
+    """, (key, file_name, size, mtime, time.time()))
+    queue.put((file_name, src_path))
+    return True
+
+
+def start_job(src_path):
+    key = journal_key(src_path)
+    with active_jobs_lock:
+        queued = enqueued_at.pop(key, None)
+    if queued is not None:
+        metrics.observe('docgen_job_wait_seconds', time.time() - queued)
+    journal_write("UPDATE jobs SET state = 'running', attempts = attempts + 1, updated_at = ? WHERE path = ?",
+                  (time.time(), key))
+
+
+def finish_job(src_path, state, error=None):
+    """
+    Journal the outcome of a job ('done' or 'failed') and release its path for new events.
+    """
+    key = journal_key(src_path)
+    journal_write("UPDATE jobs SET state = ?, error = ?, updated_at = ? WHERE path = ?",
+                  (state, error, time.time(), key))
+    with active_jobs_lock:
+        active_jobs.discard(key)
+        enqueued_at.pop(key, None)
+
+
+def read_journal(db_path):
+    """
+    Drop the old finished jobs and return the remaining ones by journal key.
+    """
+    conn = open_journal(db_path)
+    try:
+        with conn:
+            conn.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+                         (time.time() - JOURNAL_MAX_AGE,))
+        return {row['path']: row for row in conn.execute("SELECT path, size, mtime, state, attempts FROM jobs")}
+    finally:
+        conn.close()
+
+
+def scan_backlog(queue, watch_folder):
+    """
+    Queue the reports already in `watch_folder`, oldest first; the observer only reports
+    files created while it runs. Reports the journal has as done or failed in the same
+    version (size and mtime) are skipped, reports the service died on JOURNAL_MAX_ATTEMPTS
+    times go to QUARANTINE_FOLDER.
+
+    Returns:
+        int: Number of reports queued.
+    """
+    journal = {}
+    if JOURNAL_DB:
+        try:
+            journal = read_journal(JOURNAL_DB)
+        except Exception:
+            logging.error("Failed to read the job journal", exc_info=True)
+    with os.scandir(watch_folder) as entries:
+        reports = [(entry.stat(), entry.name, entry.path) for entry in entries
+                   if entry.is_file() and entry.name.endswith('.docx') and not entry.name.startswith('~$')]
+    reports.sort(key=lambda report: report[0].st_mtime)
+
+    queued = 0
+    for stat, file_name, src_path in reports:
+        row = journal.get(journal_key(src_path))
+        if row is not None and (row['size'], row['mtime']) == (stat.st_size, stat.st_mtime):
+            if row['state'] in ('done', 'failed'):
+                log.info(f"{file_name} skipped: already {row['state']}")
+                continue
+            if row['state'] == 'running' and row['attempts'] >= JOURNAL_MAX_ATTEMPTS:
+                error = JobAbortedError([f"the service stopped {row['attempts']} times while processing it"])
+                handle_failed_job(file_name, src_path, exc_info=error)
+                continue
+        if enqueue_job(queue, file_name, src_path):
+            queued += 1
+    log.info(f"{queued} reports queued from {watch_folder}")
+    return queued
+
+
+def replace_variables(output_doc, raw_doc, text_boxes=None):
+    id, address_lines = text_boxes or extract_text_boxes(raw_doc)
+    address_lines = list(address_lines)
+
+    # Extract module, kw, and date
+    module = raw_doc.tables[1].cell(4, 1).paragraphs[0].text
+    log.debug(module)
+    kw = raw_doc.tables[1].cell(2, 1).paragraphs[0].text
+    date = raw_doc.paragraphs[0].text
+    
+    # Add additional address information
+    additional_address = raw_doc.tables[0].cell(1, 0).paragraphs[0].text
+    address_lines.extend(parse_address(additional_address))
+    
+    try:
+        additional_address_line = raw_doc.tables[0].cell(1, 0).paragraphs[1].text
+        address_lines.extend(parse_address(additional_address_line))
+    except IndexError:
+        pass
+
+    # Use a set to track unique address lines
+    unique_address_lines = list(dict.fromkeys(address_lines))  # Preserve order while removing duplicates
+
+    # Remove address lines from the first page content if they are not needed
+    # Assume paragraph indices 5-7 hold the address, adjust if necessary
+    paragraphs_to_remove = [5, 6, 7]
+    for i in sorted(paragraphs_to_remove, reverse=True):
+        if i < len(output_doc.paragraphs):
+            output_doc.paragraphs[i].clear()
+
+    i = 0
+    for p in output_doc.paragraphs:
+        text = p.text
+        if i == 2:
+            p.text = ""
+            r = p.add_run(text.replace("0.00", kw))
+            title_run(r)
+        if i == 3:
+            p.text = ""
+            r = p.add_run(text.replace("0", module))
+            title_run(r)
+        elif i == 5:
+            p.text = ""
+            if len(unique_address_lines) > 0:
+                r = p.add_run(unique_address_lines[0])
+                log.debug(unique_address_lines[0])
+                title_run(r)
+        elif i == 6:
+            p.text = ""
+            if len(unique_address_lines) > 2:
+                r = p.add_run(unique_address_lines[2])
+                log.debug(unique_address_lines[2])
+                title_run(r)
+        elif i == 7:
+            p.text = ""
+            if len(unique_address_lines) > 1:
+                r = p.add_run(unique_address_lines[1])
+                log.debug(unique_address_lines[1])
+                title_run(r)
+        elif i == 8:
+            p.text = ""
+            r = p.add_run(date)
+            title_run(r)
+        i += 1
+
+def set_font(paragraph, font_name):
+    for run in paragraph.runs:
+        run.font.name = font_name
+        run._element.rPr.rFonts.set(qn('w:ascii'), font_name)
+        run._element.rPr.rFonts.set(qn('w:eastAsia'), font_name)
+        run._element.rPr.rFonts.set(qn('w:hAnsi'), font_name)
+        run._element.rPr.rFonts.set(qn('w:cs'), font_name)
+def parse_address(address_text):
+    """
+    Parse the address into a list of lines based on whether it contains a comma.
+    """
+    if ',' in address_text:
+        # Compact format with street and city in one line
+        return [line.strip() for line in address_text.split(',')]
+    else:
+        # Standard format with multiple lines
+        return address_text.splitlines()
+
+def parse_address(address_text):
+    """
+    Parse the address into a list of lines. The last part of the address should keep the city and country together.
+    """
+    if ',' in address_text:
+        # Split address based on commas
+        parts = [part.strip() for part in address_text.split(',')]
+        
+        # Handle case where the last part might be the country
+        if len(parts) > 2:
+            # Combine the city and country into a single line
+            combined = ', '.join(parts[-2:])
+            return parts[:-2] + [combined]
+        else:
+            return parts
+    else:
+        # Standard format with multiple lines
+        return address_text.splitlines()
+
+def prepare_header(output_doc, raw_doc, text_boxes=None):
+    id, address_lines = text_boxes or extract_text_boxes(raw_doc)
+    address_lines = list(address_lines)
+    date = ''
+
+    # Extract date from paragraphs
+    if raw_doc.paragraphs:
+        date = raw_doc.paragraphs[0].text
+
+    # Extract additional address information from tables if available
+    try:
+        additional_address = raw_doc.tables[0].cell(1, 0).paragraphs[0].text
+        address_lines.extend(parse_address(additional_address))
+    except IndexError:
+        pass
+
+    # Prepare the header section, the skeleton document already carries the table
+    header = output_doc.sections[0].header
+    t = header.tables[0] if header.tables else prepare_header_scaffold(output_doc)
+
+    # Cell (0, 0) content
+    cell_00 = t.cell(0, 0)
+    cell_00.text = ''
+    cell_00.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    p = cell_00.paragraphs[0]
+
+    # Add parsed address lines without duplications and empty lines
+    unique_addresses = set()
+    for line in address_lines:
+        line = line.strip()  # Remove leading/trailing whitespace
+        if line and line not in unique_addresses:
+            r = p.add_run(line)
+            r.font.size = Pt(8)
+            r.add_break()  # Only add a break if there's another line to follow
+            unique_addresses.add(line)
+    set_font(p, "Barlow")
+
+    # Remove the last line break if it exists
+    if p.runs and p.runs[-1].text.endswith('\n'):
+        p.runs[-1].text = p.runs[-1].text.rstrip('\n')
+
+    # Cell (1, 0) content
+    cell_10 = t.cell(1, 0)
+    cell_10.text = ''
+    cell_10.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.LEFT
+    p = cell_10.paragraphs[0]
+    r11 = p.add_run(date)
+    r11.font.size = Pt(8)
+    r11.add_break()
+
+    # Split `id` and handle cases where it doesn't contain a space
+    id_parts = id.split(" ")
+    if len(id_parts) > 1:
+        r21 = p.add_run(id_parts[1])
+    else:
+        r21 = p.add_run(id)  # Fallback: use the entire `id` string
+    r21.font.size = Pt(8)
+    set_font(p, "Barlow")
+
+
+def prepare_header_scaffold(output_doc):
+    """
+    Add the header table with the parts that are the same for every offer (logo, slogan).
+    The address and date cells are filled per job by prepare_header.
+    """
+    section = output_doc.sections[0]
+    header = section.header
+    section.different_first_page_header_footer = True
+    t = header.add_table(2, 2, Inches(24))
+
+    # Cell (0, 1) content
+    cell_01 = t.cell(0, 1)
+    cell_01.text = ''
+    cell_01.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    p = cell_01.paragraphs[0]
+    r21 = p.add_run()
+    r21.add_picture("assets/template_images/header.png", Cm(1.5), Cm(1.25))
+
+    # Cell (1, 1) content
+    cell_11 = t.cell(1, 1)
+    cell_11.text = ''
     cell_11.paragraphs[0].paragraph_format.alignment = WD_ALIGN_PARAGRAPH.RIGHT
     p = cell_11.paragraphs[0]
     r31 = p.add_run("Solardach 24 GmbH")
@@ -692,653 +1906,2390 @@ def prepare_header(output_doc, raw_doc):
     r42.font.color.rgb = RGBColor(250, 168, 32)
     r42.font.size = Pt(8)
     set_font(p, "Barlow")
+    return t
+
+
+
+def prepare_footer(output_doc):
+    footer = output_doc.sections[0].footer
+    p = footer.add_paragraph()
+    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    r1 = p.add_run("Solardach24 GmbH")
+    r1.add_break()
+    r2 = p.add_run("Reinacherstrasse 261 ∙ 4053 Basel")
+    r2.add_break()
+    r3 = p.add_run("Collègegasse 9 ∙ 2502 Biel/Bienne")
+    r3.add_break()
+    r4 = p.add_run("+41 61 511 22 22 ∙ office@solardach24.ch ∙ CHE-152.292-000")
+    set_font(p, "Barlow")   
+
+def add_toc(output_doc):
+    add_h1(output_doc, "INHALTSVERZEICHNIS", )
+    output_doc.add_paragraph(" ")
+    paragraph = output_doc.add_paragraph()
+    paragraph.paragraph_format.space_before = Inches(0)
+    paragraph.paragraph_format.space_after = Inches(0)
+    run = paragraph.add_run()
+    run.font.name = 'Barlow'
+    run.font.size = Pt(15)
+    fldChar = OxmlElement('w:fldChar')  # creates a new element
+    fldChar.set(qn('w:fldCharType'), 'begin')  # sets attribute on element
+
+    instrText = OxmlElement('w:instrText')
+    instrText.set(qn('xml:space'), 'preserve')  # sets attribute on element
+    instrText.text = 'TOC \\o "1-1" \\h \\z \\u'   # change 1-3 depending on heading levels you need
+
+    fldChar2 = OxmlElement('w:fldChar')
+    fldChar2.set(qn('w:fldCharType'), 'separate')
+
+    fldChar3 = OxmlElement('w:t')
+    fldChar3.text = "Right-click to update field."
+    fldChar3 = OxmlElement('w:updateFields') 
+    fldChar3.set(qn('w:val'), 'true') 
+    fldChar2.append(fldChar3)
+
+    fldChar4 = OxmlElement('w:fldChar')
+    fldChar4.set(qn('w:fldCharType'), 'end')
+
+    r_element = run._r
+    
+    run.font.color.rgb = RGBColor(250, 168, 32)
+    
+    r_element.append(fldChar)
+    r_element.append(instrText)
+    r_element.append(fldChar2)
+    r_element.append(fldChar4)
+
+    p_element = paragraph._p
+    
+def add_picture_inline(output_doc, picture_path, width, height):
+    """
+    Adds a picture to the document if it exists. In a section process the pictures of the
+    job come from its shared memory (see SharedPictures).
+    """
+    shared = attached_pictures.get(picture_path)
+    if shared is not None:
+        view, file_name = shared
+        shape = output_doc.add_picture(BytesIO(view), width, height)
+        # Named after the file, as when added from it
+        shape._inline.graphic.graphicData.pic.nvPicPr.cNvPr.name = file_name
+        return
+    full_path = picture_file(picture_path)
+    if full_path is not None:
+        output_doc.add_picture(full_path, width, height)
+
+
+def picture_file(picture_path):
+    """
+    File of a picture given without extension, None if there is none.
+    """
+    # Check for .png, .jpg, and .jp2 extensions
+    for extension in ['.png', '.jpg', '.jp2']:
+        full_path = picture_path + extension
+        if os.path.exists(full_path):
+            if extension == '.jp2':
+                # Convert jp2 to jpg
+                full_path = convert_jp2_to_jpg(full_path)
+            return full_path
+    return None
+
+def extract_para_style(raw, para_style):
+    para = []
+    for p in raw.paragraphs:
+        if p.style.name.startswith(para_style):
+                para.append(p.text)
+    return para
+
+class LeaseQueue:
+    """
+    Job queue for several machines watching the same input folders. Every machine queues
+    the reports it sees, but get() only hands a report out after creating its lease file in
+    `lease_dir` with O_EXCL, so exactly one machine processes it. The holder refreshes the
+    lease while the report is in the input folder and removes it once the report is gone.
+    A lease not refreshed for `timeout` seconds is taken over, so the reports of a dead
+    machine are processed by another one. Reports leased elsewhere are set aside and checked
+    again until they leave the folder or their lease expires.
+
+    Leases are named after the report, so report names must be unique across the watch folders,
+    and the clocks of the machines and the file server must agree to well within `timeout`.
+    """
+    def __init__(self, lease_dir, timeout=LEASE_TIMEOUT):
+        self.lease_dir = lease_dir
+        self.timeout = timeout
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.jobs = Queue()
+        self.held = {}
+        self.waiting = {}
+        self.lock = Lock()
+        self.checked = time.time()
+        os.makedirs(lease_dir, exist_ok=True)
+        Thread(target=self.heartbeat, daemon=True).start()
+
+    def lease_path(self, file_name):
+        return os.path.join(self.lease_dir, f"{file_name}.lease")
+
+    def put(self, item):
+        self.jobs.put(item)
+
+    def task_done(self):
+        self.jobs.task_done()
+
+    def join(self):
+        self.jobs.join()
+
+    def qsize(self):
+        return self.jobs.qsize()
+
+    def get(self, block=True, timeout=None):
+        """
+        Like Queue.get: raises Empty when no report could be leased within `timeout` seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if time.time() - self.checked > self.timeout / 4:
+                self.recheck()
+            wait = self.timeout / 4
+            if deadline is not None:
+                wait = min(wait, deadline - time.monotonic())
+            try:
+                item = self.jobs.get(block and wait > 0, max(wait, 0))
+            except Empty:
+                if not block or (deadline is not None and time.monotonic() >= deadline):
+                    raise
+                continue
+            file_name, src_path = item
+            lease = self.lease_path(file_name)
+            if not os.path.exists(src_path):
+                # Processed elsewhere before this machine got to it
+                finish_job(src_path, 'done')
+            elif self.acquire(lease, src_path):
+                if os.path.exists(src_path):
+                    return item
+                # Finished elsewhere, and its lease removed, since the check above
+                with self.lock:
+                    self.held.pop(lease, None)
+                try:
+                    os.remove(lease)
+                except OSError:
+                    pass
+                finish_job(src_path, 'done')
+            else:
+                with self.lock:
+                    self.waiting[lease] = item
+            self.jobs.task_done()
+
+    def expired(self, path):
+        try:
+            return time.time() - os.path.getmtime(path) > self.timeout
+        except FileNotFoundError:
+            return False
+
+    def acquire(self, lease, src_path):
+        """
+        Lease the report at `src_path` and hold it. A lease this machine still holds for an
+        earlier report of the same name (a revision dropped again) is kept.
+        """
+        with self.lock:
+            if lease in self.held:
+                self.held[lease] = src_path
+                return True
+        try:
+            fd = os.open(lease, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            if not self.take_over(lease):
+                return False
+        else:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(self.owner)
+        with self.lock:
+            self.held[lease] = src_path
+        return True
+
+    def take_over(self, lease):
+        """
+        Take over an expired lease. A guard file makes sure only one machine does.
+        """
+        if not self.expired(lease):
+            return False
+        guard = f"{lease}.takeover"
+        try:
+            os.close(os.open(guard, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except FileExistsError:
+            # Left behind by a machine that died while taking over
+            if self.expired(guard):
+                try:
+                    os.remove(guard)
+                except OSError:
+                    pass
+            return False
+        try:
+            if not self.expired(lease):
+                return False
+            with open(lease, 'w') as fp:
+                fp.write(self.owner)
+            log.info(f"Took over the expired lease {lease}")
+            return True
+        finally:
+            os.remove(guard)
+
+    def recheck(self):
+        """
+        Drop the reports set aside that were processed elsewhere, queue again those whose lease expired.
+        """
+        self.checked = time.time()
+        with self.lock:
+            waiting = list(self.waiting.items())
+        for lease, item in waiting:
+            if not os.path.exists(item[1]):
+                finish_job(item[1], 'done')
+            elif os.path.exists(lease) and not self.expired(lease):
+                continue
+            else:
+                self.jobs.put(item)
+            with self.lock:
+                del self.waiting[lease]
+
+    def heartbeat(self):
+        while True:
+            time.sleep(self.timeout / 4)
+            with self.lock:
+                held = list(self.held.items())
+            for lease, src_path in held:
+                try:
+                    with open(lease) as fp:
+                        owner = fp.read()
+                    if owner != self.owner:
+                        logging.error(f"Lease {lease} was taken over by {owner}")
+                    elif os.path.exists(src_path):
+                        os.utime(lease)
+                        continue
+                except OSError:
+                    logging.error(f"Failed to refresh the lease {lease}", exc_info=True)
+                    continue
+                with self.lock:
+                    # Unless acquire() handed it out again for a report of the same name meanwhile
+                    if self.held.get(lease) != src_path or (owner == self.owner and os.path.exists(src_path)):
+                        continue
+                    del self.held[lease]
+                    if owner == self.owner:
+                        try:
+                            os.remove(lease)
+                        except OSError:
+                            logging.error(f"Failed to remove the lease {lease}", exc_info=True)
+
+
+def is_inside(path, folder):
+    path, folder = journal_key(path), journal_key(folder)
+    try:
+        return os.path.commonpath([path, folder]) == folder
+    except ValueError:
+        # On different drives
+        return False
+
+
+def route_of(routes, src_path):
+    """
+    Returns:
+        tuple: (template_path, output_folder) of the watch folder holding `src_path`.
+    """
+    return routes[journal_key(os.path.dirname(src_path))]
+
+
+def process_files(queue, routes):
+    global flag
+    while True:
+        file_name, src_path = queue.get()
+        job_id = current_job.set(new_job_id(file_name))
+        if file_name[0]=='0':
+            flag = 0
+            log.debug('filename starts with 0')
+        else:
+            flag = 1
+            log.debug('filename does not start with 0')
+        try:
+            try:
+                template_path, output_folder = route_of(routes, src_path)
+            except KeyError:
+                handle_failed_job(file_name, src_path)
+            else:
+                with profiled(f'{output_folder}/{file_name}') if profile_requested(file_name) else nullcontext():
+                    main(file_name, src_path, template_path, output_folder)
+        finally:
+            queue.task_done()
+            current_job.reset(job_id)
+
+# Watchdog event handler. It implements dispatch itself rather than subclassing
+# FileSystemEventHandler, so watchdog is only imported when a folder is watched.
+class NewFileHandler:
+    def __init__(self, template_path, output_folder, queue):
+        self.template_path = template_path
+        self.output_folder = output_folder
+        self.queue = queue
+
+    def dispatch(self, event):
+        if event.event_type == 'created':
+            self.on_created(event)
+    
+    def on_created(self, event):
+        if event.is_directory:
+            return
+        if event.src_path.endswith('.docx'):
+            file_name = os.path.basename(event.src_path)
+            if not file_name.startswith('~$'):
+                # Queued a second later so the file is fully written, without holding up the observer
+                retries.call_later(1, enqueue_job, self.queue, file_name, event.src_path)
+
+    def move_file_with_retry(self, src, dst, max_retries=5, delay=1):
+        retries.run(f"move {src} to {dst}", shutil.move, src, dst, attempts=max_retries, delay=delay,
+                    retry_on=(PermissionError, FileNotFoundError))
+
+
+class FolderPoller(Thread):
+    """
+    Watch folders whose filesystem events are missing or unreliable. Each poll lists them
+    with os.scandir and compares (size, mtime) of the reports with the previous poll; a new
+    or changed report is queued once it stays the same for one poll, i.e. is fully written.
+    The interval drops to the fastest one while something changes and doubles up to the
+    slowest one while the folders are idle.
+    """
+    def __init__(self, queue, folders, intervals=(1, 10)):
+        super().__init__(daemon=True)
+        self.queue = queue
+        self.folders = list(folders)
+        self.fastest, self.slowest = intervals
+        self.interval = self.fastest
+        self.index = {}
+        self.pending = set()
+        self.stopped = Event()
+
+    def scan(self, folder):
+        """
+        Returns:
+            dict: (size, mtime) of the reports in `folder` by path.
+        """
+        reports = {}
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.name.endswith('.docx') and not entry.name.startswith('~$') and entry.is_file():
+                    stat = entry.stat()
+                    reports[entry.path] = (stat.st_size, stat.st_mtime)
+        return reports
+
+    def poll(self):
+        """
+        Scan the folders once and queue the reports that settled since the last poll.
+
+        Returns:
+            bool: True if a report appeared, changed or is still being written.
+        """
+        active = False
+        for folder in self.folders:
+            try:
+                current = self.scan(folder)
+            except OSError:
+                # Share offline: keep the last known state rather than treating it as emptied
+                logging.error(f"Failed to scan {folder}", exc_info=True)
+                continue
+            previous = self.index.get(folder, {})
+            for path, signature in current.items():
+                if previous.get(path) != signature:
+                    self.pending.add(path)
+                    active = True
+                elif path in self.pending:
+                    self.pending.discard(path)
+                    enqueue_job(self.queue, os.path.basename(path), path)
+                    active = True
+            self.pending.difference_update(set(previous) - set(current))
+            self.index[folder] = current
+        return active
+
+    def start(self):
+        # Reports already there are left to scan_backlog
+        for folder in self.folders:
+            try:
+                self.index[folder] = self.scan(folder)
+            except OSError:
+                logging.error(f"Failed to scan {folder}", exc_info=True)
+        super().start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            if self.poll():
+                self.interval = self.fastest
+            else:
+                self.interval = min(self.interval * 2, self.slowest)
+
+    def stop(self):
+        self.stopped.set()
+
+def read_input(src_path):
+    """
+    Read the raw report in one go; every later consumer works on these bytes.
+    """
+    with open(src_path, 'rb') as fp:
+        return fp.read()
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def main_document_part(archive):
+    """
+    Name of the main document part of an opened .docx zip. It is not always
+    word/document.xml, the package relationships point to it.
+    """
+    rels = ElementTree.fromstring(archive.read('_rels/.rels'))
+    for rel in rels:
+        if rel.get('Type', '').endswith('/officeDocument'):
+            return rel.get('Target').lstrip('/')
+    raise ValueError("Not a Word document: no main document part")
+
+
+def check_docx(data):
+    """
+    Cheap sanity check of the raw bytes before a render worker is spent on them.
+
+    Raises:
+        PreflightError: The bytes are not a .docx package.
+    """
+    try:
+        with zipfile.ZipFile(BytesIO(data)) as archive:
+            part = main_document_part(archive)
+            if part not in archive.namelist():
+                raise ValueError(f"Not a Word document: {part} is missing")
+    except (zipfile.BadZipFile, KeyError, ValueError, ElementTree.ParseError) as e:
+        raise PreflightError([f"not a valid .docx: {e}"])
+
+
+def profile_requested(file_name):
+    return os.environ.get('DOCGEN_PROFILE', '') not in ('', '0') or PROFILE_MARKER in file_name
+
+
+@contextmanager
+def profiled(path, top=PROFILE_TOP):
+    """
+    Run the block under cProfile and tracemalloc, then write the profile to `<path>.prof`
+    (for pstats or snakeviz) and the hot functions and allocation sites to `<path>.profile.txt`.
+    Both are written even if the block fails.
+    """
+    profiler = cProfile.Profile()
+    tracemalloc.start()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        ))
+        tracemalloc.stop()
+
+        summary = StringIO()
+        summary.write(f"{os.path.basename(path)}: {elapsed:.2f} s, peak traced memory {peak / 2**20:.1f} MB\n\n")
+        summary.write(f"Top {top} functions by cumulative time\n")
+        pstats.Stats(profiler, stream=summary).sort_stats('cumulative').print_stats(top)
+        summary.write(f"Top {top} allocation sites still held at the end\n")
+        for stat in snapshot.statistics('lineno')[:top]:
+            summary.write(f"{stat}\n")
+        try:
+            profiler.dump_stats(f'{path}.prof')
+            with open(f'{path}.profile.txt', 'w', encoding='utf-8') as fp:
+                fp.write(summary.getvalue())
+            log.info(f'{os.path.basename(path)}.prof written')
+        except OSError:
+            logging.error(f"Failed to write the profile of {path}", exc_info=True)
+
+
+def render_job(file_name, data, template_path, profile_path=None):
+    """
+    Render one job in a worker process, under the profiler if `profile_path` is given.
+
+    Returns:
+        bytes: The saved offer document.
+    """
+    global flag
+    flag = 0 if file_name[0] == '0' else 1
+    with profiled(profile_path) if profile_path else nullcontext():
+        doc = build_offer(file_name, data, template_path)
+        buffer = BytesIO()
+        save_offer(doc, buffer)
+    return buffer.getvalue()
+
+
+def serve_warm(template_path, output_folder, port=WARM_PORT):
+    """
+    Keep a worker warm for one-shot conversions (convert_once, warm_client.py): the render
+    dependencies are imported, the skeleton of `template_path` is built and the caches stay
+    filled between jobs. Jobs are received on 127.0.0.1:`port` and rendered one at a time,
+    with `template_path` unless they name another; clients write the offers to their own
+    output folder or to `output_folder`.
+    """
+    from multiprocessing.connection import Listener
+    # Paid now rather than by the first job
+    for module in ('docx2pdf', 'pypdf', 'PIL.Image'):
+        importlib.import_module(module)
+    load_skeleton(template_path)
+    with Listener(('127.0.0.1', port), authkey=warm_authkey(create=True)) as listener:
+        log.info(f"Warm worker listening on 127.0.0.1:{port}")
+        while True:
+            try:
+                with listener.accept() as conn:
+                    # Plain JSON and bytes, never pickles: nothing received is run
+                    request = json.loads(conn.recv_bytes())
+                    file_name, job_template_path = request['file_name'], request['template_path'] or template_path
+                    data = conn.recv_bytes()
+                    current_job.set(new_job_id(file_name))
+                    try:
+                        if PREFLIGHT:
+                            preflight(file_name, data)
+                        output = render_job(file_name, data, job_template_path)
+                    except Exception as e:
+                        logging.error(f"Warm worker failed on {file_name}", exc_info=True)
+                        reply = {'ok': False, 'error': f"{type(e).__name__}: {e}",
+                                 'reasons': getattr(e, 'reasons', None) if isinstance(e, PreflightError) else None}
+                        conn.send_bytes(json.dumps(reply).encode('utf-8'))
+                        continue
+                    conn.send_bytes(json.dumps({'ok': True, 'output_folder': os.path.abspath(output_folder)}).encode('utf-8'))
+                    conn.send_bytes(output)
+            except (OSError, EOFError, ValueError, KeyError, TypeError, multiprocessing.AuthenticationError):
+                logging.error("Warm worker connection failed", exc_info=True)
+
+
+def convert_once(src_path, template_path, output_folder):
+    """
+    Convert one report without watching or cleaning up its folder, in the warm worker if
+    one is running and in this process otherwise.
+
+    Returns:
+        str: Path of the written offer.
+    """
+    file_name = os.path.basename(src_path)
+    data = read_input(src_path)
+    try:
+        output, _ = warm_render(file_name, data, template_path)
+    except WarmJobError as e:
+        if e.reasons:
+            raise PreflightError(e.reasons) from e
+        raise
+    except (ConnectionRefusedError, FileNotFoundError):
+        if PREFLIGHT:
+            preflight(file_name, data)
+        output = render_job(file_name, data, template_path)
+    output_path = f'{output_folder}/{file_name}-output.docx'
+    with open(output_path, 'wb') as fp:
+        fp.write(output)
+    log.info(f'{file_name}-output.docx created')
+    return output_path
+
+
+class JobAbortedError(RuntimeError):
+    """
+    A render job was killed by its supervisor, or its process died.
+    """
+    def __init__(self, reasons):
+        super().__init__("; ".join(reasons))
+        self.reasons = reasons
+
+
+def process_rss(pid):
+    """
+    Resident memory of a process and its children in bytes, None if it cannot be measured.
+    """
+    if psutil is not None:
+        try:
+            process = psutil.Process(pid)
+            return process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+        except psutil.Error:
+            return None
+    try:
+        with open(f'/proc/{pid}/statm') as fp:
+            return int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def check_memory_limit():
+    """
+    Warn at startup when JOB_MAX_RSS cannot be measured as configured.
+    """
+    if JOB_MAX_RSS is None or psutil is not None:
+        return
+    if process_rss(os.getpid()) is None:
+        log.warning("psutil is not installed, JOB_MAX_RSS is not enforced")
+    else:
+        log.warning("psutil is not installed, JOB_MAX_RSS only counts the render processes, not their section processes")
+
+
+def render_worker_main(conn):
+    """
+    Body of a render process: render the jobs received on `conn` until it is closed or the
+    supervising process is gone.
+    """
+    parent = multiprocessing.parent_process()
+    # Forked from the service: start from empty metrics, they are sent back per job
+    metrics.reset()
+    # Log records too; the service writes them with the ID of the job
+    collector = CollectingHandler()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(collector)
+    log.setLevel(logging.DEBUG if JOB_LOG_FOLDER else LOG_LEVEL)
+    try:
+        serve_render_jobs(conn, parent, collector)
+    finally:
+        shutdown_section_pool()
+
+
+def serve_render_jobs(conn, parent, collector):
+    """
+    Job loop of render_worker_main.
+    """
+    while True:
+        # Other workers may hold a copy of our pipe, so EOF alone is not reliable
+        while not conn.poll(1.0):
+            if parent is not None and not parent.is_alive():
+                return
+        try:
+            file_name, data, template_path, profile_path = conn.recv()
+        except EOFError:
+            return
+        try:
+            output = render_job(file_name, data, template_path, profile_path)
+            conn.send((True, output, None, metrics.drain(), collector.drain()))
+        except Exception as e:
+            collected, records = metrics.drain(), collector.drain()
+            try:
+                conn.send((False, e, traceback.format_exc(), collected, records))
+            except Exception:
+                # The exception itself cannot be pickled
+                conn.send((False, RuntimeError(repr(e)), traceback.format_exc(), collected, records))
+
+
+class RenderWorker:
+    """
+    A render process supervised by the pipeline. Jobs are sent to it over a pipe while the
+    calling thread watches the clock and the process memory; a job past JOB_TIMEOUT or above
+    JOB_MAX_RSS gets the process killed, and the next job starts a fresh one. The process is
+    kept between jobs, so the imports and caches are paid for once.
+
+    The process is not daemonic, so it can start the section pool; stop it explicitly.
+    Processes still running when the service exits are stopped by stop_all.
+    """
+    # How often the limits are checked, in seconds
+    POLL_INTERVAL = 0.5
+    # Workers with a live process
+    running = set()
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+
+    def start(self):
+        parent_conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=render_worker_main, args=(child_conn,))
+        self.process.start()
+        child_conn.close()
+        self.conn = parent_conn
+        RenderWorker.running.add(self)
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+        self.process = self.conn = None
+        RenderWorker.running.discard(self)
+
+    @classmethod
+    def stop_all(cls):
+        """
+        Stop every render process. Runs at exit, before multiprocessing joins the
+        non-daemonic processes, which would otherwise wait for us to go away.
+        """
+        for worker in list(cls.running):
+            worker.stop()
+
+    def exit_reason(self):
+        self.process.join(self.POLL_INTERVAL)
+        return f"render process exited with code {self.process.exitcode}"
+
+    def render(self, file_name, data, template_path, profile_path=None):
+        """
+        Render one job, blocking the calling thread.
+
+        Returns:
+            bytes: The saved offer document.
+
+        Raises:
+            JobAbortedError: The job broke a limit or the process died.
+        """
+        if self.process is None or not self.process.is_alive():
+            self.stop()
+            self.start()
+        self.conn.send((file_name, data, template_path, profile_path))
+        started = time.monotonic()
+        while not self.conn.poll(self.POLL_INTERVAL):
+            reasons = []
+            if not self.process.is_alive():
+                reasons.append(self.exit_reason())
+            elapsed = time.monotonic() - started
+            if JOB_TIMEOUT is not None and elapsed > JOB_TIMEOUT:
+                reasons.append(f"still running after {elapsed:.0f} s (JOB_TIMEOUT is {JOB_TIMEOUT} s)")
+            rss = process_rss(self.process.pid) if JOB_MAX_RSS is not None else None
+            if rss is not None and rss > JOB_MAX_RSS:
+                reasons.append(f"using {rss / 2**20:.0f} MB of memory (JOB_MAX_RSS is {JOB_MAX_RSS / 2**20:.0f} MB)")
+            if reasons:
+                self.stop()
+                raise JobAbortedError(reasons)
+        try:
+            ok, value, remote_traceback, collected, records = self.conn.recv()
+        except EOFError:
+            reason = self.exit_reason()
+            self.stop()
+            raise JobAbortedError([reason])
+        metrics.merge(collected)
+        replay_records(records)
+        if not ok:
+            value.__cause__ = RuntimeError(f"in the render process\n{remote_traceback}")
+            raise value
+        return value
+
+
+atexit.register(RenderWorker.stop_all)
+
+
+def parse_input(job):
+    """
+    Parse stage of a job: check the raw bytes and their structure (preflight), hash them and
+    read the offer metadata.
+    """
+    check_docx(job['data'])
+    if PREFLIGHT:
+        preflight(job['file_name'], job['data'])
+    job['sha256'] = content_hash(job['data'])
+    try:
+        job['metadata'] = extract_offer_metadata(job['data'])
+    except Exception:
+        # Only used for the index; it is read back from the output instead
+        job['metadata'] = None
+
+
+def write_output(job):
+    """
+    Final stage: save the rendered offer and remove the raw report, or route it to INVALID_FOLDER.
+    An output file locked by another program is written later by `retries`, and the job is
+    completed then.
+    """
+    file_name, src_path = job['file_name'], job['src_path']
+    if job.get('error') is not None:
+        handle_failed_job(file_name, src_path, exc_info=job['error'])
+        return
+    output_path = f"{job['output_folder']}/{file_name}-output.docx"
+    retries.run(f"write {output_path}", write_file_atomic, output_path, job['output'],
+                on_success=lambda: complete_job(job, output_path),
+                on_failure=lambda error: handle_failed_job(file_name, src_path, exc_info=error))
+
+
+def complete_job(job, output_path):
+    file_name, src_path = job['file_name'], job['src_path']
+    log.info(f'{file_name}-output.docx created')
+    clear_folder_contents(file_name, os.path.dirname(src_path))
+    record_offer(job.get('metadata'), src_path, output_path, job.get('sha256'), time.time() - job['received'])
+    finish_job(src_path, 'done')
+    metrics.inc('docgen_jobs_total', (('outcome', 'done'),))
+    metrics.observe('docgen_job_seconds', time.time() - job['received'])
+
+
+def next_job(queue, stop):
+    """
+    Wait for the next job on `queue`, None once `stop` is set.
+    """
+    while not stop.is_set():
+        try:
+            return queue.get(timeout=0.5)
+        except Empty:
+            pass
+    return None
+
+
+async def ingest_stage(queue, parse_queue, routes, stop):
+    while True:
+        item = await asyncio.to_thread(next_job, queue, stop)
+        if item is None:
+            return
+        file_name, src_path = item
+        job = {'id': new_job_id(file_name), 'file_name': file_name, 'src_path': src_path, 'received': time.time()}
+        current_job.set(job['id'])
+        try:
+            job['template_path'], job['output_folder'] = route_of(routes, src_path)
+            if profile_requested(file_name):
+                job['profile_path'] = f"{job['output_folder']}/{file_name}"
+            with timed_stage('read'):
+                job['data'] = await asyncio.to_thread(read_input, src_path)
+        except (KeyError, OSError) as e:
+            job['error'] = e
+        await parse_queue.put(job)
+
+
+async def parse_stage(parse_queue, render_queue, write_queue):
+    while True:
+        job = await parse_queue.get()
+        current_job.set(job['id'])
+        if job.get('error') is None:
+            try:
+                with timed_stage('parse'):
+                    await asyncio.to_thread(parse_input, job)
+            except Exception as e:
+                job['error'] = e
+        await (write_queue if job.get('error') is not None else render_queue).put(job)
+
+
+async def render_stage(worker, render_queue, write_queue):
+    while True:
+        job = await render_queue.get()
+        current_job.set(job['id'])
+        # Only now it counts as an attempt: the job may have waited in the stage queues
+        await asyncio.to_thread(start_job, job['src_path'])
+        metrics.add('docgen_render_workers_busy', 1)
+        started = time.perf_counter()
+        try:
+            with timed_stage('render'):
+                job['output'] = await asyncio.to_thread(worker.render, job['file_name'], job['data'], job['template_path'],
+                                                        job.get('profile_path'))
+        except Exception as e:
+            job['error'] = e
+        finally:
+            metrics.add('docgen_render_workers_busy', -1)
+            metrics.inc('docgen_render_busy_seconds_total', value=time.perf_counter() - started)
+        job['data'] = None
+        await write_queue.put(job)
+
+
+async def write_stage(queue, write_queue):
+    while True:
+        job = await write_queue.get()
+        current_job.set(job['id'])
+        try:
+            with timed_stage('write'):
+                await asyncio.to_thread(write_output, job)
+        except Exception as e:
+            logging.error(f"Failed to write output of {job['file_name']}", exc_info=True)
+            # A report still in the watch folder is picked up again by the next scan_backlog
+            state = 'queued' if os.path.exists(job['src_path']) else 'failed'
+            await asyncio.to_thread(finish_job, job['src_path'], state, str(e))
+        finally:
+            queue.task_done()
+
+
+async def pipeline(queue, routes, render_workers=1, stop=None):
+    """
+    Process the jobs put on `queue` in four stages connected by bounded queues:
+    read the raw bytes, check them, render in supervised worker processes (RenderWorker)
+    and write the output. File I/O of one job overlaps with the rendering of the others.
+    `routes` maps each watch folder (journal_key) to its (template_path, output_folder).
+    Runs until the Event `stop` is set.
+    """
+    stop = stop or Event()
+    parse_queue = asyncio.Queue(maxsize=2 * render_workers)
+    render_queue = asyncio.Queue(maxsize=render_workers)
+    write_queue = asyncio.Queue(maxsize=2 * render_workers)
+    workers = [RenderWorker() for _ in range(render_workers)]
+    metrics.set('docgen_render_workers', render_workers)
+    metrics.set('docgen_render_workers_busy', 0)
+    stages = [
+        ingest_stage(queue, parse_queue, routes, stop),
+        parse_stage(parse_queue, render_queue, write_queue),
+        write_stage(queue, write_queue),
+    ]
+    stages += [render_stage(worker, render_queue, write_queue) for worker in workers]
+    tasks = [asyncio.create_task(stage) for stage in stages]
+    try:
+        # Only the ingest stage ends by itself, once `stop` is set
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Also ends the threads still waiting for a render
+        for worker in workers:
+            worker.stop()
+        await asyncio.get_running_loop().shutdown_default_executor()
+
+
+def run_pipeline(queue, routes, render_workers=1, stop=None):
+    asyncio.run(pipeline(queue, routes, render_workers, stop))
+
+
+# Main function to set up watchdog observer
+def set_(watch_folder, template_path, output_folder, render_workers=1):
+    serve([(watch_folder, template_path, output_folder)], render_workers)
+
+
+def serve(watch_routes, render_workers=1):
+    """
+    Watch the folders of `watch_routes`, a list of (watch_folder, template_path, output_folder),
+    and convert new reports with the template and into the output folder of their watch folder.
+    All folders share one job queue and one set of workers, and with them the skeleton and
+    fragment caches. With render_workers=0 the jobs run one after the other on a single
+    thread (process_files), without the JOB_TIMEOUT and JOB_MAX_RSS limits; otherwise they
+    go through the staged pipeline with that many supervised render processes.
+    """
+    routes = {journal_key(watch_folder): (template_path, output_folder)
+              for watch_folder, template_path, output_folder in watch_routes}
+    watch_folders = [watch_folder for watch_folder, _, _ in watch_routes]
+    if LEASE_DIR:
+        for watch_folder in watch_folders:
+            if is_inside(LEASE_DIR, watch_folder):
+                raise ValueError(f"LEASE_DIR {LEASE_DIR} is inside the watch folder {watch_folder}, "
+                                 "where the cleanup after every job would remove it")
+    queue = LeaseQueue(LEASE_DIR) if LEASE_DIR else Queue()
+    metrics.set('docgen_queue_depth', queue.qsize)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    if POLL_INTERVALS:
+        observer = FolderPoller(queue, watch_folders, POLL_INTERVALS)
+    else:
+        from watchdog.observers import Observer
+        observer = Observer()
+        for watch_folder, template_path, output_folder in watch_routes:
+            event_handler = NewFileHandler(template_path, output_folder, queue)
+            observer.schedule(event_handler, path=watch_folder, recursive=False)
+    observer.start()
+
+    # Catch up with the reports left in the folders while the service was down
+    for watch_folder in watch_folders:
+        scan_backlog(queue, watch_folder)
+
+    # Start worker thread to process files from the queue
+    stop = Event()
+    if render_workers:
+        check_memory_limit()
+        worker_thread = Thread(target=run_pipeline, args=(queue, routes, render_workers, stop), daemon=True)
+    else:
+        worker_thread = Thread(target=process_files, args=(queue, routes), daemon=True)
+    worker_thread.start()
+
+    try:
+        while True:
+            time.sleep(0.02)
+    except KeyboardInterrupt:
+        observer.stop()
+    observer.join()
+    queue.join()  # Wait for all tasks to be processed 
+    # Let the pipeline shut down its loop and threads, or the interpreter waits for them at exit
+    stop.set()
+    if render_workers:
+        worker_thread.join()
+
+
+    # Save the updated document
+
+# Function to remove the prefix from the title
+def remove_prefix_from_title(doc):
+    # Iterate through all paragraphs to find the title
+    for para in doc.paragraphs:
+        if para.text.startswith("Projektbericht - "):
+            # Remove the prefix
+            para.text = para.text.replace("Projektbericht - ", "", 1)
+            break
+
+# Static trailer pages: (H1 title, picture, width, height)
+TRAILER_PAGES = [
+    ("6. Warum Solardach24 GmbH?", "assets/template_images/image2.png", Inches(6.5), Inches(7)),
+    ("7. Wer wir sind.", "assets/template_images/image3.png", Inches(6.5), Inches(7)),
+    ("8. Unser Haustechnik-Partner. Für Ihre persönliche Energiewende.", "assets/template_images/image4.png", Inches(5.8), Inches(5.5)),
+    ("9. Unsere Elektropartner. Für Ihre Sicherheit.", "assets/template_images/image5.png", Inches(6), Inches(6)),
+    ("10. Unser Versicherungspartner. Exklusiv bei der Solardach24.", "assets/template_images/image6.png", Inches(5), Inches(6)),
+    ("11. Unsere Lieferanten. Für die besten Komponenten.", "assets/template_images/image7.png", Inches(6), Inches(6)),
+    ("12. Gesellschaftliches Engagement und Mitgliedschaften", "assets/template_images/image8.png", Inches(6), Inches(6)),
+]
+
+# (template path, mtime) -> (saved skeleton bytes, number of body elements before the trailer)
+skeleton_cache = {}
+
+
+def build_skeleton(template_path):
+    """
+    Build the part of the offer that does not depend on the report: cover, copied template
+    paragraphs, table of contents, trailer pages, header scaffolding, footer and page numbers.
+
+    Returns:
+        tuple: The skeleton Document and the number of body elements before the trailer.
+    """
+    template = Document(f'{template_path}')
+    doc = Document()
+    doc.add_picture("assets/template_images/image1.png", width=Inches(6), height=Inches(4))
+    last_paragraph = doc.paragraphs[-1]
+    last_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
+
+    ## headings upto table of contents
+    doc.add_paragraph(" ")
+    for paragraph in template.paragraphs[12:20]:
+        copy_paragraph(doc, paragraph)
+
+    doc.add_paragraph(" ")
+    add_toc(doc)
+    doc.add_page_break()
+
+    # The report body is spliced in here
+    trailer_start = len(body_elements(doc))
+
+    doc.add_page_break()
+    for title, picture, width, height in TRAILER_PAGES:
+        add_h1(doc, title)
+        doc.add_picture(picture, width=width, height=height)
+
+    prepare_header_scaffold(doc)
+    prepare_footer(doc)
+    add_page_numbers(doc)
+    return doc, trailer_start
+
+
+def body_elements(doc):
+    """
+    Block level elements of the document body, without the final section properties.
+    """
+    return [el for el in doc.element.body.iterchildren() if el.tag != qn('w:sectPr')]
+
+
+def load_skeleton(template_path):
+    """
+    Open a fresh copy of the cached skeleton for one job. The trailer is detached so the
+    report body can be appended with the usual add_* calls; put it back with splice_trailer.
+
+    Returns:
+        tuple: The Document and the list of detached trailer elements.
+    """
+    key = (os.path.abspath(template_path), os.path.getmtime(template_path))
+    cached = skeleton_cache.get(key)
+    metrics.inc('docgen_cache_requests_total', (('cache', 'skeleton'), ('result', 'miss' if cached is None else 'hit')))
+    if cached is None:
+        skeleton, trailer_start = build_skeleton(template_path)
+        buffer = BytesIO()
+        skeleton.save(buffer)
+        cached = skeleton_cache[key] = (buffer.getvalue(), trailer_start)
+
+    data, trailer_start = cached
+    doc = Document(BytesIO(data))
+    trailer = body_elements(doc)[trailer_start:]
+    for el in trailer:
+        doc.element.body.remove(el)
+    return doc, trailer
+
+
+OPC_CONTENT_TYPES_NS = 'http://schemas.openxmlformats.org/package/2006/content-types'
+OPC_RELS_CONTENT_TYPE = 'application/vnd.openxmlformats-package.relationships+xml'
+
+
+def save_offer(doc, target):
+    """
+    Save `doc` like Document.save, but store the pictures that are compressed already
+    (STORED_MEDIA) instead of deflating them again, and deflate the XML parts at
+    SAVE_DEFLATE_LEVEL. `target` is a path or a writable binary file.
+    """
+    package = doc.part.package
+    parts = list(package.iter_parts())
+    for part in parts:
+        part.before_marshal()
+
+    defaults = {'rels': OPC_RELS_CONTENT_TYPE, 'xml': 'application/xml'}
+    overrides = []
+    for part in parts:
+        ext = part.partname.ext.lower()
+        if f'.{ext}' in STORED_MEDIA:
+            defaults.setdefault(ext, part.content_type)
+        else:
+            overrides.append((part.partname, part.content_type))
+    content_types = [f'<Types xmlns="{OPC_CONTENT_TYPES_NS}">']
+    content_types += [f'<Default Extension="{ext}" ContentType="{content_type}"/>' for ext, content_type in defaults.items()]
+    content_types += [f'<Override PartName="{partname}" ContentType="{content_type}"/>' for partname, content_type in overrides]
+    content_types.append('</Types>')
+
+    with zipfile.ZipFile(target, 'w', zipfile.ZIP_DEFLATED, compresslevel=SAVE_DEFLATE_LEVEL) as archive:
+        archive.writestr('[Content_Types].xml', "<?xml version='1.0' encoding='UTF-8' standalone='yes'?>\n" + ''.join(content_types))
+        archive.writestr('_rels/.rels', package.rels.xml)
+        for part in parts:
+            name = part.partname.membername
+            if name.lower().endswith(STORED_MEDIA):
+                archive.writestr(name, part.blob, compress_type=zipfile.ZIP_STORED)
+            else:
+                archive.writestr(name, part.blob)
+            if len(part.rels):
+                archive.writestr(part.partname.rels_uri.membername, part.rels.xml)
+
+
+def splice_trailer(doc, trailer):
+    body = doc.element.body
+    sectPr = body.find(qn('w:sectPr'))
+    for el in trailer:
+        if sectPr is not None:
+            sectPr.addprevious(el)
+        else:
+            body.append(el)
+
+
+def renumber_drawings(doc):
+    """
+    Give every drawing of the body a unique wp:docPr id. The trailer is detached while the
+    body is rendered (load_skeleton), so python-docx hands out ids its pictures already use.
+    """
+    for drawing_id, docPr in enumerate(doc.element.body.iter(qn('wp:docPr')), start=1):
+        docPr.set('id', str(drawing_id))
+
+
+# Sizes used by the picture steps of the section recipe
+IMAGE_SIZES = {
+    'large': (Inches(6), Inches(4)),
+    'plan': (Inches(5.5), Inches(6.5)),
+    'small-plan': (Inches(5.5), Inches(3.5)),
+}
+
+DATENBLATT_WECHSELRICHTER_STOPS = ("Datenblatt Batteriesystem", "Datenblatt Batterie", "Schaltplan",
+                                   "Übersichtsplan", "Bemaßungsplan", "Strangplan", "Stückliste")
+
+# Declarative description of the report body.
+#
+# Every entry is one section. 'heading' is matched against the raw document headings
+# ('match' is 'h2' (default), 'h2-substring' or 'h1'); entries without a heading always run.
+# 'steps' is executed in order with a paragraph cursor placed on the heading:
+#   ('chapter', n)            numbered H1 taken from the next Heading 1 of the raw document
+#   ('page_break',)           page break
+#   ('paragraph', text)       plain paragraph
+#   ('h2'|'h3', x)            heading; x is fixed text, an offset from the cursor, or omitted (section heading)
+#   ('table',)                copy the next raw table
+#   ('datasheet',)            copy the next raw table through the fragment cache, already styled
+#   ('table-picture', flag)   copy the next raw table and put the next picture into it
+#   ('image', source, size)   picture from the job ('job'), from assets ('assets') or a fixed job picture number
+#   ('advance', n)            move the cursor
+#   ('if-para', text, steps)  run steps if the raw document contains a paragraph with that text
+#   ('when', cond, steps)     run steps if the paragraph under the cursor matches cond
+#   ('mark', name)            set a mark for the rest of the section, tested by the ('marked', name) condition
+#   ('each', spec)            repeat spec['steps'] for every paragraph matching spec['while']
+SECTION_RECIPE = [
+    {'name': 'Kapitel 1', 'steps': [('chapter', 1)]},
+    {'name': 'Übersichtsbild', 'steps': [('image', 'job', 'large'), ('paragraph', " ")]},
+    {'heading': "PV-Anlage", 'match': 'h2-substring', 'missing': "PV-Anlage not found in headings",
+     'steps': [('h2',), ('h3', 4), ('table',), ('image', 'job', 'large')]},
+    {'heading': "Ertragsprognose",
+     'steps': [('h2',), ('h3', "Ertragsprognose"), ('table',)]},
+    {'name': 'Kapitel 2', 'steps': [('page_break',), ('chapter', 2)]},
+    {'heading': "Überblick",
+     'steps': [('h2',),
+               ('h3', "Anlagendaten"), ('table',),
+               ('h3', "Klimadaten"), ('table',),
+               ('h3', "Verbrauch"), ('table',),
+               ('paragraph', ""), ('image', 'assets', 'large')]},
+    {'heading': "Modulflächen",
+     'steps': [('page_break',), ('h2',),
+               ('each', {'start': 1, 'stride': 3, 'while': ('contains', "Modulfläche"),
+                         'steps': [('h2', 0), ('h3', 1), ('table',), ('paragraph', ""),
+                                   ('image', 'job', 'large')]})]},
+    {'name': "Horizontlinie, 3D-Planung",
+     'steps': [('h2', "Horizontlinie, 3D-Planung"), ('image', 'job', 'large'), ('page_break',)]},
+    {'heading': "Wechselrichterverschaltung",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('not-h1',),
+                         'steps': [('when', ('startswith', "Verschaltung"), [('mark', 'verschaltung'), ('h3', 0), ('table',)]),
+                                   # Only the Wechselrichter lines inside a Verschaltung block have a table
+                                   ('when', ('marked', 'verschaltung'),
+                                    [('when', ('startswith', "Wechselrichter"), [('table',)])])]})]},
+    {'heading': "AC-Netz",
+     'steps': [('h2',), ('h3', 1), ('table',)]},
+    {'heading': "Batteriesysteme",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('contains', "Batteriesystem"),
+                         'steps': [('h3', 0), ('table',)]})]},
+    {'name': 'Kapitel 3', 'steps': [('page_break',), ('chapter', 3)]},
+    {'heading': "Ergebnisse Gesamtanlage",
+     'steps': [('h2',), ('advance', 1),
+               ('if-para', "PV-Anlage", [('h3', "PV-Anlage"), ('table-picture', False), ('advance', 1)]),
+               ('if-para', "Verbraucher", [('h3', "Verbraucher"), ('table-picture', True), ('advance', 1)]),
+               ('if-para', "Batteriesystem", [('h3', "Batteriesystem"), ('table',), ('advance', 1)]),
+               ('if-para', "Autarkiegrad", [('h3', "Autarkiegrad"), ('table',), ('advance', 1)]),
+               ('paragraph', ""),
+               ('each', {'start': 0, 'while': ('contains', "Abbildung"),
+                         'steps': [('image', 'job', 'large')]})]},
+    {'heading': "Ergebnisse pro Modulfläche",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('not-chapter',), 'tolerant': True,
+                         'steps': [('h3', 0), ('table',)]})]},
+    {'name': 'Kapitel 4', 'steps': [('chapter', 4)]},
+    {'heading': "Energiebilanz Sankey-Diagramm", 'match': 'h1',
+     'steps': [('h2',), ('image', 'job', 'plan')]},
+    {'heading': "Datenblatt PV-Modul",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('contains', "PV-Modul"),
+                         'steps': [('h3', 0), ('datasheet',)]})]},
+    {'heading': "Datenblatt Wechselrichter",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('not-startswith', DATENBLATT_WECHSELRICHTER_STOPS),
+                         'tolerant': True, 'steps': [('h3', 0), ('datasheet',)]})]},
+    {'heading': "Datenblatt Batteriesystem",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('startswith', "Batteriesystem"),
+                         'steps': [('h3', 0), ('datasheet',)]})]},
+    {'heading': "Datenblatt Batterie",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('not-chapter',), 'tolerant': True,
+                         'steps': [('h3', 0), ('datasheet',)]})]},
+    {'name': 'Kapitel 5', 'steps': [('page_break',), ('chapter', 5)]},
+    {'heading': "Schaltplan",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('contains', "Abbildung"),
+                         'steps': [('image', 'job', 'plan')]})]},
+    {'heading': "Übersichtsplan",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('contains', "Abbildung"),
+                         'steps': [('image', 'job', 'plan')]})]},
+    {'heading': "Bemaßungsplan",
+     'steps': [('h2',),
+               ('each', {'start': 1, 'while': ('contains', "Abbildung"),
+                         'steps': [('image', 'job', 'plan')]})]},
+    {'name': 'Seitenumbruch', 'steps': [('page_break',)]},
+    {'heading': "Strangplan",
+     'steps': [('h2',),
+               ('each', {'start': 0, 'while': ('any',),
+                         'steps': [('image', 'job', 'plan')]})]},
+    {'heading': "Stückliste",
+     'steps': [('h2',), ('h3', 1)]},
+    {'heading': "Umgebung",
+     'steps': [('h2',), ('image', 2, 'small-plan')]},
+]
+
+
+class SnapshotTable(Table):
+    """
+    Table of the raw document whose merged-cell grid is resolved once.
+    """
+    def __init__(self, table):
+        super().__init__(table._tbl, table._parent)
+        self._grid = None
+
+    @property
+    def _cells(self):
+        if self._grid is None:
+            self._grid = Table._cells.fget(self)
+        return self._grid
+
+
+class RawSnapshot:
+    """
+    Read-only view of the raw document for one job. python-docx builds a new proxy list on
+    every access of .paragraphs/.tables; here they are materialized once and shared by the
+    section engine and all extractors.
+    """
+    def __init__(self, raw):
+        self.document = raw
+        self.paragraphs = raw.paragraphs
+        self.tables = [SnapshotTable(table) for table in raw.tables]
+        self.inline_shapes = raw.inline_shapes
+
+
+class RenderState:
+    """
+    Per-job state shared by the compiled section steps: the output document, the raw
+    document, the heading/paragraph index of the raw document and the running counters.
+
+    With doc=None the recipe is only planned: the steps read their inputs and move the
+    counters but add nothing (see preflight).
+    """
+    def __init__(self, doc, raw, folder_path, previous=None):
+        self.doc = doc
+        self.raw = raw
+        self.folder_path = folder_path
+        self.h1 = extract_para_style(raw, 'Heading 1')
+        self.h2 = extract_para_style(raw, 'Heading 2')
+        self.h1_set = set(self.h1)
+        self.h2_set = set(self.h2)
+        self.para = [p.text for p in raw.paragraphs if p.text != '']
+        # First position of every paragraph text, replaces para.index() scans
+        self.para_index = {}
+        for idx, text in enumerate(self.para):
+            self.para_index.setdefault(text, idx)
+        self.table_index = 1
+        self.pic_index = 2
+        self.h1_index = 0
+        self.cursor = 0
+        self.flag = flag
+        # Marks set by the ('mark', name) steps of the current section
+        self.marks = set()
+        self.timings = {}
+        # (section name, tables used, pictures used) per section run
+        self.usage = []
+        self.section = None
+        # Tables spliced in already styled from the fragment cache
+        self.preformatted = set()
+        # Section records of the previous revision of the offer (name -> record). With None
+        # nothing is recorded, otherwise this render's records are collected in `sections`
+        # and the pictures they embed in `blobs` (sha1 -> bytes).
+        self.previous = previous
+        self.sections = None if previous is None else {}
+        self.blobs = {}
+        # Cursor, table, picture and chapter counters at the start of the current section;
+        # recorded inputs are relative to them
+        self.base = None
+        self.reads = None
+        # The base counters of every section run, name -> (cursor, table, picture, chapter)
+        self.bases = {}
+        # Pictures of the job in shared memory while sections render in the pool
+        self.shared = None
+
+    def find(self, heading, substring=False):
+        if not substring:
+            return self.para_index.get(heading)
+        return next((idx for idx, text in enumerate(self.para) if heading in text), None)
+
+    # The section steps read the raw document only through the methods below, so the
+    # inputs of a section can be recorded (note) and compared with a later revision (read).
+
+    def read(self, kind, arg):
+        """
+        Current value of one section input, relative to the start of the section.
+        """
+        anchor, table_base, pic_base, h1_base = self.base
+        if kind == 'para':
+            idx = anchor + arg
+            return self.para[idx] if idx < len(self.para) else None
+        if kind == 'table':
+            idx = table_base + arg
+            return table_digest(self.raw.tables[idx]) if idx < len(self.raw.tables) else None
+        if kind == 'picture':
+            return picture_digest(f"{self.folder_path}/images/{pic_base + arg}")
+        if kind == 'file':
+            return picture_digest(f"{self.folder_path}/images/{arg}")
+        if kind == 'asset':
+            return pic_base + arg
+        if kind == 'h1':
+            idx = h1_base + arg
+            return self.h1[idx] if idx < len(self.h1) else None
+        if kind == 'is-h1':
+            return arg in self.h1_set
+        if kind == 'has':
+            return arg in self.para_index
+        if kind == 'flag':
+            return self.flag
+        raise ValueError(f"Unknown section input: {kind!r}")
+
+    def note(self, kind, arg):
+        if self.reads is not None:
+            self.reads.append([kind, arg, self.read(kind, arg)])
+
+    def text(self, idx):
+        """
+        Paragraph text at idx, None past the end of the document.
+        """
+        self.note('para', idx - self.base[0])
+        return self.para[idx] if idx < len(self.para) else None
+
+    def next_table(self):
+        self.note('table', self.table_index - self.base[1])
+        return self.raw.tables[self.table_index]
+
+    def job_picture(self):
+        """
+        Path of the next extracted picture, without extension.
+        """
+        self.note('picture', self.pic_index - self.base[2])
+        return f"{self.folder_path}/images/{self.pic_index}"
+
+    def job_file(self, name):
+        self.note('file', name)
+        return f"{self.folder_path}/images/{name}"
+
+    def asset_picture(self):
+        self.note('asset', self.pic_index - self.base[2])
+        return f"assets/images/{self.pic_index}"
+
+    def chapter_title(self):
+        """
+        Next Heading 1 of the raw document, None when there are no more.
+        """
+        self.note('h1', self.h1_index - self.base[3])
+        return self.h1[self.h1_index] if self.h1_index < len(self.h1) else None
+
+    def is_h1(self, text):
+        self.note('is-h1', text)
+        return text in self.h1_set
+
+    def has_para(self, text):
+        self.note('has', text)
+        return text in self.para_index
+
+    def job_flag(self):
+        self.note('flag', None)
+        return self.flag
+
+
+def compile_condition(cond):
+    kind = cond[0]
+    if kind == 'contains':
+        return lambda state, text: cond[1] in text
+    if kind == 'startswith':
+        return lambda state, text: text.startswith(cond[1])
+    if kind == 'not-startswith':
+        return lambda state, text: not text.startswith(cond[1])
+    if kind == 'not-h1':
+        return lambda state, text: not state.is_h1(text)
+    if kind == 'marked':
+        return lambda state, text: cond[1] in state.marks
+    if kind == 'not-chapter':
+        def not_chapter(state, text):
+            # The loop ends at the next chapter heading, or at once if there is none
+            title = state.chapter_title()
+            return title is not None and text != title
+        return not_chapter
+    if kind == 'any':
+        return lambda state, text: True
+    raise ValueError(f"Unknown recipe condition: {cond!r}")
+
+
+def compile_text(arg, heading):
+    if arg is None:
+        return lambda state: heading
+    if isinstance(arg, int):
+        return lambda state: state.text(state.cursor + arg)
+    return lambda state: arg
+
+
+def compile_steps(steps, heading):
+    compiled = [compile_step(step, heading) for step in steps]
+
+    def run(state):
+        for step in compiled:
+            step(state)
+    return run
+
+
+def compile_step(step, heading):
+    kind = step[0]
+    label = heading or "Recipe"
+
+    if kind == 'chapter':
+        number = step[1]
+
+        def chapter(state):
+            title = state.chapter_title()
+            if title is not None:
+                if state.doc is not None:
+                    add_h1(state.doc, f"{number}. {title}")
+                state.h1_index += 1
+        return chapter
+
+    if kind == 'page_break':
+        def page_break(state):
+            if state.doc is not None:
+                state.doc.add_page_break()
+        return page_break
+
+    if kind == 'paragraph':
+        text = step[1]
+
+        def paragraph(state):
+            if state.doc is not None:
+                state.doc.add_paragraph(text)
+        return paragraph
+
+    if kind in ('h2', 'h3'):
+        add_heading = add_h2 if kind == 'h2' else add_h3
+        text = compile_text(step[1] if len(step) > 1 else None, heading)
+
+        def heading_step(state):
+            title = text(state)
+            if state.doc is not None:
+                add_heading(state.doc, title)
+        return heading_step
+
+    if kind == 'datasheet':
+        def datasheet(state):
+            raw_table = state.next_table()
+            if state.doc is not None:
+                copy_styled_table(state.doc, raw_table, state.preformatted)
+                log.debug(f"{label} table copied - {state.table_index}")
+            state.table_index += 1
+        return datasheet
+
+    if kind == 'table':
+        def table(state):
+            raw_table = state.next_table()
+            if state.doc is not None:
+                copy_table(state.doc, raw_table)
+                log.debug(f"{label} table copied - {state.table_index}")
+            state.table_index += 1
+        return table
+
+    if kind == 'table-picture':
+        needs_flag = step[1]
+
+        def table_picture(state):
+            raw_table = state.next_table()
+            if state.doc is not None:
+                table = copy_table(state.doc, raw_table)
+                log.debug(f"{label} table copied - {state.table_index}")
+            if not needs_flag or state.job_flag() != 0:
+                path = state.job_picture()
+                shared = attached_pictures.get(path)
+                if state.doc is not None and shared is not None and shared[1].endswith('.png'):
+                    format_table_with_picture(state.doc, table, BytesIO(shared[0]), name=shared[1])
+                elif state.doc is not None:
+                    try:
+                        format_table_with_picture(state.doc, table, f"{path}.png")
+                    except:
+                        format_table_with_picture(state.doc, table, f"{path}.jpg")
+                state.pic_index += 1
+            state.table_index += 1
+        return table_picture
+
+    if kind == 'image':
+        source, size = step[1], IMAGE_SIZES[step[2]]
+
+        def image(state):
+            if source == 'job':
+                path = state.job_picture()
+            elif source == 'assets':
+                path = state.asset_picture()
+            else:
+                path = state.job_file(source)
+                if state.doc is not None:
+                    add_picture_inline(state.doc, path, width=size[0], height=size[1])
+                return
+            if state.doc is not None:
+                add_picture_inline(state.doc, path, width=size[0], height=size[1])
+            state.pic_index += 1
+        return image
+
+    if kind == 'mark':
+        mark = step[1]
+
+        def set_mark(state):
+            state.marks.add(mark)
+        return set_mark
+
+    if kind == 'advance':
+        offset = step[1]
+
+        def advance(state):
+            state.cursor += offset
+        return advance
+
+    if kind == 'if-para':
+        text, body = step[1], compile_steps(step[2], heading)
+
+        def if_para(state):
+            if state.has_para(text):
+                body(state)
+        return if_para
+
+    if kind == 'when':
+        cond, body = compile_condition(step[1]), compile_steps(step[2], heading)
+
+        def when(state):
+            if cond(state, state.text(state.cursor)):
+                body(state)
+        return when
+
+    if kind == 'each':
+        spec = step[1]
+        start, stride = spec.get('start', 1), spec.get('stride', 1)
+        tolerant = spec.get('tolerant', False)
+        cond, body = compile_condition(spec['while']), compile_steps(spec['steps'], heading)
+
+        def each(state):
+            state.cursor += start
+            while True:
+                text = state.text(state.cursor)
+                if text is None or not cond(state, text):
+                    break
+                try:
+                    body(state)
+                except Exception:
+                    if not tolerant:
+                        raise
+                    break
+                state.cursor += stride
+        return each
+
+    raise ValueError(f"Unknown recipe step: {step!r}")
+
+
+def compile_recipe(recipe):
+    """
+    Compile the section recipe into (name, matcher, anchor, steps, missing) tuples
+    executed by render_sections.
+    """
+    compiled = []
+    for entry in recipe:
+        heading = entry.get('heading')
+        match = entry.get('match', 'h2')
+        if heading is None:
+            applies = lambda state: True
+        elif match == 'h2':
+            applies = lambda state, heading=heading: heading in state.h2_set
+        elif match == 'h2-substring':
+            applies = lambda state, heading=heading: any(heading in h for h in state.h2)
+        elif match == 'h1':
+            applies = lambda state, heading=heading: heading in state.h1_set
+        else:
+            raise ValueError(f"Unknown recipe match: {match!r}")
+        compiled.append((entry.get('name', heading), applies, heading, match == 'h2-substring',
+                         compile_steps(entry['steps'], heading), entry.get('missing')))
+    return compiled
+
+
+COMPILED_RECIPE = compile_recipe(SECTION_RECIPE)
+RECIPE_CHAPTERS = sum(1 for entry in SECTION_RECIPE for step in entry['steps'] if step[0] == 'chapter')
+# Stored section records are only reused with the recipe they were rendered with
+RECIPE_DIGEST = hashlib.sha1(repr(SECTION_RECIPE).encode('utf-8')).hexdigest()
+
+
+def render_sections(state, recipe=COMPILED_RECIPE, fragments=None):
+    """
+    Run the compiled section recipe against one job, recording the time spent per section.
+    When the state carries the previous revision of the offer, sections whose inputs did
+    not change are copied from it instead. Sections with a future in `fragments` (name ->
+    future) were rendered in the section pool and are spliced in.
+    """
+    for name, applies, heading, substring, steps, missing in recipe:
+        started = time.perf_counter()
+        if applies(state):
+            if heading is not None:
+                state.cursor = state.find(heading, substring)
+            state.base = (state.cursor, state.table_index, state.pic_index, state.h1_index)
+            state.bases[name] = state.base
+            state.section = name
+            state.marks.clear()
+            if fragments is not None and splice_fragment(state, name, fragments.get(name)):
+                log.debug(f"{name} rendered in the section pool")
+            elif state.sections is None:
+                steps(state)
+            elif state.previous is None:
+                # Recorded to be spliced in by another process (render_fragment)
+                record_section(state, name, steps)
+            elif reuse_section(state, name):
+                log.info(f"{name} reused from the previous revision")
+                metrics.inc('docgen_cache_requests_total', (('cache', 'revision'), ('result', 'hit')))
+            else:
+                record_section(state, name, steps)
+                metrics.inc('docgen_cache_requests_total', (('cache', 'revision'), ('result', 'miss')))
+            state.usage.append((name, state.table_index - state.base[1], state.pic_index - state.base[2]))
+        elif missing:
+            log.info(missing)
+        state.timings[name] = state.timings.get(name, 0) + time.perf_counter() - started
+
+
+class PreflightError(ValueError):
+    """
+    The raw report does not have the structure the section recipe expects.
+    """
+    def __init__(self, reasons):
+        super().__init__("; ".join(reasons))
+        self.reasons = reasons
+
+
+def preflight(file_name, data):
+    """
+    Check a raw report before the PDF conversion and the rendering: it must parse, hold
+    every table the recipe copies, have every chapter and enough pictures. The recipe is
+    planned on the raw document (see RenderState), so the checks follow the recipe.
+    Problems the renderer gets past (no offer number, tables that are not where the recipe
+    expects them) are logged as warnings.
+
+    Raises:
+        PreflightError: With every problem found.
+    """
+    try:
+        raw_document = Document(BytesIO(data))
+    except Exception as e:
+        raise PreflightError([f"not a readable Word document ({e})"])
+    raw = RawSnapshot(raw_document)
+    state = RenderState(None, raw, None)
+    state.flag = 0 if file_name[0] == '0' else 1
+    reasons = []
+    warnings = []
+
+    offer_id, _ = extract_text_boxes(raw)
+    if not offer_id.startswith("Angebotsnr."):
+        warnings.append("no offer number (Angebotsnr.) text box on the cover page")
+
+    start_tables = state.table_index
+    start_pictures = state.pic_index
+    try:
+        render_sections(state)
+    except Exception as e:
+        reasons.append(f"section '{state.section}' cannot be built: {e!r}")
+        raise PreflightError(reasons)
+
+    if state.h1_index < RECIPE_CHAPTERS:
+        reasons.append(f"{len(state.h1)} chapter headings (Heading 1), the offer has {RECIPE_CHAPTERS} chapters")
+
+    # Tables are copied by position: a section using more or fewer tables than there are under
+    # its heading shifts the ones all later sections get. A table belongs to the section whose
+    # heading is the Heading 1/2 above it. The tables the recipe reads exist (render_sections
+    # ran), so the layout is only warned about.
+    expected = {None: start_tables}
+    for name, tables, pictures in state.usage:
+        expected[name] = expected.get(name, 0) + tables
+    found = {None: 0}
+    unused = {}
+    heading = owner = None
+    for block in raw_document.iter_inner_content():
+        if isinstance(block, Table):
+            if owner is False:
+                unused[heading] = unused.get(heading, 0) + 1
+            else:
+                found[owner] = found.get(owner, 0) + 1
+        elif block.text in state.h1_set or block.text in state.h2_set:
+            if block.style.name.startswith(('Heading 1', 'Heading 2')):
+                heading = block.text
+                owner = section_of_heading(heading) or False
+    for name in [None] + [entry[0] for entry in COMPILED_RECIPE]:
+        has, uses = found.get(name, 0), expected.get(name, 0)
+        if has != uses:
+            where = f"section '{name}'" if name is not None else "the cover page"
+            warnings.append(f"{where} has {has} tables, the offer uses {uses}")
+    for heading, tables in unused.items():
+        warnings.append(f"{tables} tables under '{heading}', which is not a section of the offer")
+
+    pictures = sum(1 for part in raw_document.part.package.iter_parts() if part.content_type.startswith('image/'))
+    placed = state.pic_index - start_pictures
+    if pictures < placed:
+        reasons.append(f"{pictures} pictures, the offer places {placed}")
+
+    for warning in warnings:
+        log.warning(f"{file_name}: {warning}")
+    if reasons:
+        raise PreflightError(reasons)
+
+
+def section_of_heading(text):
+    """
+    Name of the recipe section a raw heading starts: the section with exactly that heading,
+    else the first one matching it by substring. None if there is none.
+    """
+    near = None
+    for name, applies, heading, substring, steps, missing in COMPILED_RECIPE:
+        if heading == text:
+            return name
+        if near is None and substring and heading in text:
+            near = name
+    return near
+
+
+def body_length(body):
+    return len(body) - (len(body) > 0 and body[-1].tag == qn('w:sectPr'))
+
+
+def record_section(state, name, steps):
+    """
+    Run one section while recording the inputs it reads, and store what it added to the
+    body before the final formatting passes touch it.
+    """
+    body = state.doc.element.body
+    start = body_length(body)
+    anchor, tables, pictures, chapters = state.base
+    state.reads = []
+    try:
+        steps(state)
+    finally:
+        reads, state.reads = state.reads, None
+    elements = body[start:body_length(body)]
 
+    images = {}
+    related = state.doc.part.related_parts
+    for el in elements:
+        for blip in el.iter(qn('a:blip')):
+            rId = blip.get(qn('r:embed'))
+            part = related.get(rId)
+            if part is not None and part.content_type.startswith('image/'):
+                sha = hashlib.sha1(part.blob).hexdigest()
+                state.blobs[sha] = part.blob
+                images[rId] = sha
+    styles = {val for el in elements for val in el.xpath('./w:pPr/w:pStyle/@w:val')}
+    state.sections[name] = {
+        'reads': reads,
+        'moves': [state.cursor - anchor, state.table_index - tables,
+                  state.pic_index - pictures, state.h1_index - chapters],
+        'xml': [etree.tostring(el, encoding='unicode') for el in elements],
+        'preformatted': [idx for idx, el in enumerate(elements) if el in state.preformatted],
+        'images': images,
+        'headings': [level for level in HEADING_FONTS if f'Heading{level}' in styles],
+    }
 
 
-def prepare_footer(output_doc):
-    footer = output_doc.sections[0].footer
-    p = footer.add_paragraph()
-    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
-    r1 = p.add_run("Solardach24 GmbH")
-    r1.add_break()
-    r2 = p.add_run("Reinacherstrasse 261 ∙ 4053 Basel")
-    r2.add_break()
-    r3 = p.add_run("Collègegasse 9 ∙ 2502 Biel/Bienne")
-    r3.add_break()
-    r4 = p.add_run("+41 61 511 22 22 ∙ office@solardach24.ch ∙ CHE-152.292-000")
-    set_font(p, "Barlow")   
+def reuse_section(state, name):
+    """
+    Copy a section from the previous revision if every input it read then still has the
+    same value. Rendering is deterministic, so the section would come out the same.
 
-def add_toc(output_doc):
-    add_h1(output_doc, "INHALTSVERZEICHNIS", )
-    output_doc.add_paragraph(" ")
-    paragraph = output_doc.add_paragraph()
-    paragraph.paragraph_format.space_before = Inches(0)
-    paragraph.paragraph_format.space_after = Inches(0)
-    run = paragraph.add_run()
-    run.font.name = 'Barlow'
-    run.font.size = Pt(15)
-    fldChar = OxmlElement('w:fldChar')  # creates a new element
-    fldChar.set(qn('w:fldCharType'), 'begin')  # sets attribute on element
+    Returns:
+        bool: True if the section was copied.
+    """
+    record = state.previous.get(name)
+    if record is None or any(state.read(kind, arg) != value for kind, arg, value in record['reads']):
+        return False
+    store = get_revision_store()
+    blobs = {}
+    try:
+        for old, sha in record['images'].items():
+            with open(store.blob_path(sha), 'rb') as fp:
+                blobs[old] = fp.read()
+    except OSError:
+        return False
+    splice_section(state, name, record, blobs)
+    return True
 
-    instrText = OxmlElement('w:instrText')
-    instrText.set(qn('xml:space'), 'preserve')  # sets attribute on element
-    instrText.text = 'TOC \\o "1-1" \\h \\z \\u'   # change 1-3 depending on heading levels you need
 
-    fldChar2 = OxmlElement('w:fldChar')
-    fldChar2.set(qn('w:fldCharType'), 'separate')
+def splice_section(state, name, record, blobs):
+    """
+    Append a section record (see record_section) to the document and move the counters past
+    it. `blobs` holds the pictures it embeds by their relationship ID in the record.
+    """
+    doc = state.doc
+    # Pictures get new relationships in this document. From a stream python-docx names
+    # the part after the picture format.
+    rIds = {old: doc.part.get_or_add_image(BytesIO(blob))[0] for old, blob in blobs.items()}
+    for idx, xml in enumerate(record['xml']):
+        el = append_block(doc, parse_xml(xml))
+        for blip in el.iter(qn('a:blip')):
+            old = blip.get(qn('r:embed'))
+            if old in rIds:
+                blip.set(qn('r:embed'), rIds[old])
+        for docPr in el.iter(qn('wp:docPr')):
+            docPr.set('id', str(doc.part.next_id))
+        if idx in record['preformatted']:
+            state.preformatted.add(el)
+    for level in record['headings']:
+        set_heading_style(doc, level)
+    cursor, tables, pictures, chapters = record['moves']
+    state.cursor += cursor
+    state.table_index += tables
+    state.pic_index += pictures
+    state.h1_index += chapters
+    if state.sections is not None:
+        state.sections[name] = record
 
-    fldChar3 = OxmlElement('w:t')
-    fldChar3.text = "Right-click to update field."
-    fldChar3 = OxmlElement('w:updateFields') 
-    fldChar3.set(qn('w:val'), 'true') 
-    fldChar2.append(fldChar3)
 
-    fldChar4 = OxmlElement('w:fldChar')
-    fldChar4.set(qn('w:fldCharType'), 'end')
+def table_digest(table):
+    return hashlib.sha1(etree.tostring(table._tbl)).hexdigest()
 
-    r_element = run._r
-    
-    run.font.color.rgb = RGBColor(250, 168, 32)
-    
-    r_element.append(fldChar)
-    r_element.append(instrText)
-    r_element.append(fldChar2)
-    r_element.append(fldChar4)
 
-    p_element = paragraph._p
-    
-def add_picture_inline(output_doc, picture_path, width, height):
+def picture_digest(path):
+    # Same extension order as add_picture_inline
+    for extension in ('.png', '.jpg', '.jp2'):
+        try:
+            with open(path + extension, 'rb') as fp:
+                return extension + hashlib.sha1(fp.read()).hexdigest()
+        except OSError:
+            continue
+    return None
+
+
+def write_file_atomic(path, data):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Not left behind in a synced output folder when the target is locked
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class RevisionStore:
     """
-    Adds a picture to the document if it exists.
+    Rendered sections of processed offers, keyed by offer number, so a revision of an offer
+    only renders the sections whose inputs changed. One JSON record per offer; pictures are
+    stored once per content hash in `folder`/blobs and shared by all records.
     """
-    # Check for .png, .jpg, and .jp2 extensions
-    for extension in ['.png', '.jpg', '.jp2']:
-        full_path = picture_path + extension
-        if os.path.exists(full_path):
-            if extension == '.jp2':
-                # Convert jp2 to jpg
-                full_path = convert_jp2_to_jpg(full_path)
-            
-            # Add the image to the document
-            output_doc.add_picture(full_path, width, height)
-            return  # Exit once the image is added successfully
-        else:
-            continue
-    
-    # Log an error if the image is not found
-    return
+    # Bump when the section output changes without a change of SECTION_RECIPE
+    VERSION = 1
 
-def extract_para_style(raw, para_style):
-    para = []
-    for p in raw.paragraphs:
-        if p.style.name.startswith(para_style):
-                para.append(p.text)
-    return para
+    def __init__(self, folder, max_age=90 * 24 * 3600):
+        self.folder = folder
+        self.max_age = max_age
+        self.writes = 0
+        os.makedirs(os.path.join(folder, 'blobs'), exist_ok=True)
 
-def process_files(queue, template_path, output_folder):
-    global flag
-    while True:
-        file_name, src_path = queue.get()
-        if file_name[0]=='0':
-            flag = 0
-            print('filename starts with 0')
-        else:
-            flag = 1
-            print('filename does not start with 0')
+    def record_path(self, offer_number):
+        return os.path.join(self.folder, hashlib.sha1(offer_number.encode('utf-8')).hexdigest() + '.json')
+
+    def blob_path(self, sha):
+        return os.path.join(self.folder, 'blobs', sha)
+
+    def load(self, offer_number):
         try:
-            main(file_name, src_path, template_path, output_folder)
-        finally:
-            queue.task_done()
+            with open(self.record_path(offer_number), encoding='utf-8') as fp:
+                record = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        if record.get('version') != [self.VERSION, RECIPE_DIGEST]:
+            return None
+        return record
 
-# Watchdog event handler
-class NewFileHandler(FileSystemEventHandler):
-    def __init__(self, template_path, output_folder, queue):
-        self.template_path = template_path
-        self.output_folder = output_folder
-        self.queue = queue
-    
-    def on_created(self, event):
-        if event.is_directory:
+    def save(self, offer_number, record, blobs):
+        try:
+            for sha, blob in blobs.items():
+                if not os.path.exists(self.blob_path(sha)):
+                    write_file_atomic(self.blob_path(sha), blob)
+            record = dict(record, version=[self.VERSION, RECIPE_DIGEST], offer_number=offer_number)
+            write_file_atomic(self.record_path(offer_number), json.dumps(record).encode('utf-8'))
+        except OSError:
+            logging.error(f"Failed to store the sections of offer {offer_number}", exc_info=True)
             return
-        if event.src_path.endswith('.docx'):
-            file_name = os.path.basename(event.src_path)
-            if not file_name.startswith('~$'):
-                time.sleep(1)  # Ensure the file is fully written
-                self.queue.put((file_name, event.src_path))
+        self.writes += 1
+        if self.writes % 100 == 0:
+            self.prune()
 
-    def move_file_with_retry(self, src, dst, max_retries=5, delay=1):
-        for _ in range(max_retries):
-            try:
-                shutil.move(src, dst)
-                return
-            except (PermissionError, FileNotFoundError):
-                time.sleep(delay)
-        print(f"Failed to move {src} to {dst} after {max_retries} retries.")
+    def prune(self):
+        """
+        Remove records older than max_age, then the pictures no record refers to.
+        """
+        now = time.time()
+        used = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    if now - entry.stat().st_mtime > self.max_age:
+                        os.remove(entry.path)
+                        continue
+                    with open(entry.path, encoding='utf-8') as fp:
+                        record = json.load(fp)
+                except (OSError, ValueError):
+                    continue
+                for section in record.get('sections', {}).values():
+                    used.update(section['images'].values())
+        with os.scandir(os.path.join(self.folder, 'blobs')) as entries:
+            for entry in entries:
+                # Skip fresh blobs, their record may not be written yet
+                if entry.name not in used and now - entry.stat().st_mtime > 3600:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
 
-# Main function to set up watchdog observer
-def set_(watch_folder, template_path, output_folder):
-    queue = Queue()
-    event_handler = NewFileHandler(template_path, output_folder, queue)
-    
-    observer = Observer()
-    observer.schedule(event_handler, path=watch_folder, recursive=False)
-    observer.start()
 
-    # Start worker thread to process files from the queue
-    worker_thread = Thread(target=process_files, args=(queue, template_path, output_folder), daemon=True)
-    worker_thread.start()
+revision_stores = {}
+
 
+def get_revision_store():
+    if REVISION_CACHE_DIR is None:
+        return None
+    store = revision_stores.get(REVISION_CACHE_DIR)
+    if store is None:
+        store = revision_stores[REVISION_CACHE_DIR] = RevisionStore(REVISION_CACHE_DIR)
+    return store
+
+
+def offer_number_of(data):
     try:
-        while True:
-            time.sleep(0.02)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
-    queue.join()  # Wait for all tasks to be processed 
+        return extract_offer_metadata(data)['offer_number'] or None
+    except Exception:
+        return None
 
 
-    # Save the updated document
+def build_offer(fileName, data, template_path):
+    """
+    Build the offer document for one raw report.
 
-# Function to remove the prefix from the title
-def remove_prefix_from_title(doc):
-    # Iterate through all paragraphs to find the title
-    for para in doc.paragraphs:
-        if para.text.startswith("Projektbericht - "):
-            # Remove the prefix
-            para.text = para.text.replace("Projektbericht - ", "", 1)
-            break
+    The raw report is only read once by the caller. python-docx parses it from memory and
+    the PDF conversion gets a copy in a private local working folder, so the converted PDF
+    and extracted pictures never touch the watch folder and parallel jobs do not collide.
 
-def main(fileName, filepath, template_path, output_folder):
-    global count, verb, flag
-    global INVALID_FOLDER
-    try:
-        print(f'New document added: {fileName}')
-        raw = Document(f'{filepath}')
-        remove_prefix_from_title(raw)
+    If an earlier revision of the same offer is in the revision store, its unchanged
+    sections are reused. The pictures are always extracted again: which ones the PDF holds
+    depends on the page layout, which a text-only revision can change.
 
+    Args:
+        fileName (str): Name of the raw report.
+        data (bytes): Content of the raw report.
+        template_path (str): Path of the offer template.
 
-        template = Document(f'{template_path}')
-        doc = Document()
-        print(raw)
-        print(f"Total number of tables: {len(raw.tables)}")
-        
+    Returns:
+        Document: The finished offer, not yet saved.
+    """
+    log.info(f'New document added: {fileName}')
+    raw_document = Document(BytesIO(data))
+    remove_prefix_from_title(raw_document)
+    raw = RawSnapshot(raw_document)
+
+    doc, trailer = load_skeleton(template_path)
+    log.debug(raw_document)
+    log.debug(f"Total number of tables: {len(raw.tables)}")
+
+    store = get_revision_store()
+    offer_number = offer_number_of(data) if store is not None else None
+    previous = store.load(offer_number) if offer_number else None
+
+    folder_path = tempfile.mkdtemp(prefix='docgen-')
+    try:
+        filepath = os.path.join(folder_path, fileName)
+        with open(filepath, 'wb') as fp:
+            fp.write(data)
         # Extract images from raw document - these a document specific images
         extract_raw_document_images(filepath)
-        folder_path = os.path.dirname(filepath)
-        doc.add_picture("assets/template_images/image1.png", width=Inches(6), height=Inches(4))
-        last_paragraph = doc.paragraphs[-1] 
-        last_paragraph.alignment = WD_ALIGN_PARAGRAPH.CENTER
-
-        ## headings upto table of contents
-        doc.add_paragraph(" ")
-        for paragraph in template.paragraphs[12:20]:
-            copy_paragraph(doc, paragraph)
-
-        # -------------------------------------------------  
-        doc.add_paragraph(" ")
-        add_toc(doc)
-        doc.add_page_break()
-        # ---------------------------------------------------
-
-        tableIndex = 1
-        h1_index = 0
-        h2_index = 0
-        h3_index = 0
-        pic_index = 2
-        h1 = extract_para_style(raw, 'Heading 1')
-        h2 = extract_para_style(raw, 'Heading 2')
-        h3 = extract_para_style(raw, 'Heading 3')
-        para = []
-        for p in raw.paragraphs:
-            if p.text != '':
-                para.append(p.text)
-        try:
-            add_h1(doc, f"1. {h1[h1_index]}")
-            h1_index+=1
-        except:
-            pass
-        add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(6), height=Inches(4))
-        pic_index+=1
-        
-        doc.add_paragraph(" ")
-        if any("PV-Anlage" in h for h in h2):
-            # This condition checks if "PV-Anlage" is in any of the headings of h2
-            add_h2(doc, "PV-Anlage")
-            
-            # Search for the index of the paragraph containing "PV-Anlage"
-            i = next((idx for idx, p in enumerate(para) if "PV-Anlage" in p), None)
-            
-            if i is not None:
-                add_h3(doc, para[i+4])
-                
-                # Remove the processed 'PV-Anlage' from the list
-                #para.remove('PV-Anlage')
-                
-                # Copy the table and add the picture
-                copy_table(doc, raw.tables[tableIndex])
-                print(f"PV-Anlage table copied - {tableIndex}")
-                tableIndex += 1
+        previous_sections = (previous or {}).get('sections', {}) if offer_number else None
+        state = render_report(doc, raw, folder_path, previous_sections, data, template_path)
+    finally:
+        shutil.rmtree(folder_path, ignore_errors=True)
 
-                add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(6), height=Inches(4))
-                
-                # Increment the picture index
-                pic_index += 1
+    splice_trailer(doc, trailer)
+    renumber_drawings(doc)
+
+    link_headers_and_footers(doc)
+
+    # The text boxes are read once and shared by the header and the cover page
+    text_boxes = extract_text_boxes(raw)
+    prepare_header(doc, raw, text_boxes)
+    replace_variables(doc, raw, text_boxes)
+    set_font_to_barlow(doc, state.preformatted)
+
+    format_table(doc, state.preformatted)
+    darken_first_row_bottom_border(doc, state.preformatted)
+    update_module_name(doc)
+    # Remove empty paragraphs and sections
+    #remove_empty_paragraphs(doc)
+    #remove_empty_sections(doc)
+    if offer_number:
+        store.save(offer_number, {'sections': state.sections}, state.blobs)
+    return doc
+
+
+def render_report(doc, raw, folder_path, previous_sections=None, data=None, template_path=None):
+    """
+    Render the report body using the pictures extracted into folder_path. With
+    previous_sections (a dict, possibly empty) the sections are recorded for reuse.
+
+    Big offers rendered from scratch are split over the section pool when the raw report
+    (`data`) and `template_path` are given (see SECTION_WORKERS). The sections come back as
+    records like those of the revision store and are spliced in in recipe order.
+    """
+    state = RenderState(doc, raw, folder_path, previous_sections)
+    fragments = None
+    try:
+        if (data is not None and SECTION_WORKERS > 1 and not previous_sections
+                and len(raw.tables) >= SECTION_MIN_TABLES):
+            try:
+                state.shared = SharedPictures(folder_path)
+            except OSError:
+                log.warning("Pictures not shared with the section pool", exc_info=True)
+            try:
+                fragments = submit_fragments(state, data, template_path)
+            except (BrokenProcessPool, OSError):
+                # A section process died: the pool is started again for the next offer
+                log.warning("Section pool unavailable, rendering the sections here", exc_info=True)
+                shutdown_section_pool()
+        render_sections(state, fragments=fragments)
+    finally:
+        if state.shared is not None:
+            state.shared.release()
+    for future in dict.fromkeys((fragments or {}).values()):
+        error = future.exception()
+        if error is None:
+            _, _, collected, records = future.result()
+            metrics.merge(collected)
+            replay_records(records)
         else:
-            print("PV-Anlage not found in headings")
-        
-        if "Ertragsprognose" in h2 :
-            add_h2(doc, "Ertragsprognose")
-            add_h3(doc, "Ertragsprognose")
-            copy_table(doc, raw.tables[tableIndex])
-            print(f"Ertragsprognose table copied - {tableIndex}")
-            # print(tableIndex)
-            tableIndex+=1
-
-        # ----------------------------------------
-        doc.add_page_break()
-        # ----------------------------------------
-        try:
-            add_h1(doc, f"2. {h1[h1_index]}")
-            h1_index+=1
-        except:
-            pass
-        if "Überblick" in h2 :
-            add_h2(doc, "Überblick")
-
-            add_h3(doc, "Anlagendaten")
-            copy_table(doc, raw.tables[tableIndex])
-            print(f"Anlagendaten table copied - {tableIndex}")
-            # print(tableIndex)
-            tableIndex+=1
-            
-            add_h3(doc, "Klimadaten")
-            copy_table(doc, raw.tables[tableIndex])
-            print(f"Klimadaten table copied - {tableIndex}")
-            # print(tableIndex)
-            tableIndex+=1
-            
-            add_h3(doc, "Verbrauch")
-            copy_table(doc, raw.tables[tableIndex])
-            print(f"Verbrauch table copied - {tableIndex}")
-            # print(tableIndex)
-            tableIndex+=1
-
-            doc.add_paragraph("")
-            add_picture_inline(doc, f"assets/images/{pic_index}", width=Inches(6), height=Inches(4))
-            pic_index+=1
-
-        if "Modulflächen" in h2 :
-            doc.add_page_break()
-            add_h2(doc, "Modulflächen")
-            k = para.index("Modulflächen")
-            
-            for i in range(k+1, len(para), 3):
-                if 'Modulfläche' in para[i]:
-                    
-                    add_h2(doc, para[i])
-                    add_h3(doc, para[i+1])
-                    copy_table(doc, raw.tables[tableIndex])
-                    print(f"Modulfläche {i} table copied - {tableIndex}")
-                    tableIndex+=1
-                    doc.add_paragraph("")
-                    add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(6), height=Inches(4))
-                    pic_index+=1
-                else:
-                    break
+            log.warning("A run of sections failed in the section pool and was rendered here", exc_info=error)
+            if isinstance(error, BrokenProcessPool):
+                shutdown_section_pool()
+    log.debug("Section timings: " + ", ".join(f"{name} {seconds*1000:.1f}ms" for name, seconds in state.timings.items()))
+    return state
 
-        add_h2(doc, "Horizontlinie, 3D-Planung")
-        add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(6), height=Inches(4))
-        pic_index+=1
 
-        # ----------------------------------------
-        doc.add_page_break()
-        # ----------------------------------------
+section_pool = None
+section_collector = None
+# The raw report of the job a section process works on, (sha1, RawSnapshot)
+fragment_raw = (None, None)
+# Pictures of the job a section process works on, path without extension -> (memoryview, file name)
+attached_pictures = {}
 
-        if "Wechselrichterverschaltung" in h2:
-            add_h2(doc, "Wechselrichterverschaltung")
-            
-            # Find the index of "Wechselrichterverschaltung" in paragraphs
-            i = para.index("Wechselrichterverschaltung") + 1  # Start just after the heading
-            
-            # Loop through paragraphs until the next major section or the end
-            while i < len(para):
-                # Check if a subheading like "Verschaltung" is present
-                if para[i].startswith("Verschaltung"):
-                    add_h3(doc, para[i])  # Add subheading
-
-                    # Add the associated table
-                    copy_table(doc, raw.tables[tableIndex])
-                    print(f"Verschaltung {i} table copied - {tableIndex}")
-                    tableIndex += 1
-                    
-                    # Check for another table under the same subheading
-                    while i + 1 < len(para) and not para[i+1].startswith("Verschaltung") and not para[i+1] in h1:
-                        i += 1
-                        if para[i].startswith("Wechselrichter"):
-                            # Process additional content if needed
-                            # Assume the next table belongs to the same subheading
-                            copy_table(doc, raw.tables[tableIndex])
-                            print(f"Wechselrichter {i} table copied - {tableIndex}")
-                            tableIndex += 1
-
-                # Stop when reaching the next major section or the end of the document
-                if i + 1 < len(para) and para[i+1] in h1:
-                    break
-                
-                i += 1  # Move to the next paragraph
-
-        if "AC-Netz" in h2 :
-            add_h2(doc, "AC-Netz")
-            i = para.index("AC-Netz")
-            add_h3(doc, para[i+1])
-            copy_table(doc, raw.tables[tableIndex])
-            print(f"AC-Netz table copied - {tableIndex}")
-            # # print(tableIndex)
-            tableIndex+=1
-
-
-        if "Batteriesysteme" in h2 :
-            add_h2(doc, "Batteriesysteme")
-            i = para.index("Batteriesysteme")
-            for k in range(i+1, len(para), 1):
-                if 'Batteriesystem' in para[k]:
-                    add_h3(doc, para[k])
-                    copy_table(doc, raw.tables[tableIndex])
-                    print(f"Batteriesysteme table copied - {tableIndex}")
-                    tableIndex+=1
-                else:
-                    break
-          
 
-        # ----------------------------------------
-        doc.add_page_break()
-        # ----------------------------------------
+class SharedPictures:
+    """
+    The pictures of one job in shared memory blocks, read (and converted from jp2) once by
+    the render process. Section processes embed them from the blocks (attach_pictures) and
+    send back only their sha1 instead of pickled bytes; the render process splices them in
+    from the same blocks. The blocks are unlinked when the last reference is released: the
+    job holds one, and every run of sections in the pool one until it is done.
+    """
+    def __init__(self, folder_path):
+        # (block, memoryview of the picture in it)
+        self.blocks = []
+        # Picture path without extension -> (block name, size, sha1, file name), sent to the
+        # section processes
+        self.manifest = {}
+        # sha1 -> memoryview of the picture
+        self.views = {}
+        self.refs = 1
+        self.lock = Lock()
+        folder = f"{folder_path}/images"
+        names = sorted(os.listdir(folder)) if os.path.isdir(folder) else []
         try:
-            add_h1(doc, f"3. {h1[h1_index]}")
-            h1_index+=1
-        except:
-            pass
-        if "Ergebnisse Gesamtanlage" in h2 :
-            add_h2(doc, "Ergebnisse Gesamtanlage")
-            i = para.index("Ergebnisse Gesamtanlage")
-            i+=1
-            if "PV-Anlage" in para:
-                add_h3(doc, "PV-Anlage")
-                # here index represent table no of the raw document
-                copy_table(doc, raw.tables[tableIndex])
-                print(f"PV-Anlage table copied - {tableIndex}")
-                # print(tableIndex)
-                # index represent table no of the output document
-                try:
-                    format_table_with_picture(doc, tableIndex-1, f"{folder_path}/images/{pic_index}.png")
-                except:
-                    format_table_with_picture(doc, tableIndex-1, f"{folder_path}/images/{pic_index}.jpg")
-                pic_index+=1
-           
-                tableIndex+=1
-                i+=1
-            
-            if "Verbraucher" in para:
-                add_h3(doc, "Verbraucher")
-                # here index represent table no of the raw document
-                copy_table(doc, raw.tables[tableIndex])
-                print(f"Verbraucher table copied - {tableIndex}")
-                # print(tableIndex)
-                if flag == 0:
-                    pass
-                else:
-                    # index represent table no of the output document
-                    try:
-                        format_table_with_picture(doc, tableIndex-1, f"{folder_path}/images/{pic_index}.png")
-                        
-                    except: 
-                        format_table_with_picture(doc, tableIndex-1, f"{folder_path}/images/{pic_index}.jpg")
-                    pic_index+=1
-                tableIndex+=1
-                i+=1
-            
-            if "Batteriesystem" in para:
-                add_h3(doc, "Batteriesystem")
-                copy_table(doc, raw.tables[tableIndex])
-                print(f"Batteriesystem table copied - {tableIndex}")
-                # print(tableIndex)
-                tableIndex+=1
-                i+=1
-
-            if "Autarkiegrad" in para:
-                add_h3(doc, "Autarkiegrad")
-                copy_table(doc, raw.tables[tableIndex])
-                print(f"Autarkiegrad table copied - {tableIndex}")
-                # print(tableIndex)
-                tableIndex+=1
-                i+=1
-
-            doc.add_paragraph("")
+            for stem in dict.fromkeys(os.path.splitext(name)[0] for name in names):
+                path = f"{folder}/{stem}"
+                full_path = picture_file(path)
+                if full_path is None:
+                    continue
+                size = os.path.getsize(full_path)
+                block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+                view = block.buf[:size]
+                self.blocks.append((block, view))
+                with open(full_path, 'rb') as fp:
+                    fp.readinto(view)
+                sha = hashlib.sha1(view).hexdigest()
+                self.views.setdefault(sha, view)
+                self.manifest[path] = (block.name, size, sha, os.path.basename(full_path))
+        except BaseException:
+            self.release()
+            raise
 
-            while True:
-                if 'Abbildung' in para[i]: 
-                    add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(6), height=Inches(4))
-                    pic_index+=1
-                    i+=1
-                else: 
-                    break
+    def picture(self, sha):
+        return self.views.get(sha)
 
-        if "Ergebnisse pro Modulfläche" in h2 :
-            add_h2(doc, "Ergebnisse pro Modulfläche")
-            i = para.index("Ergebnisse pro Modulfläche")
-            while (para[i+1] != h1[h1_index]):
-                try:
-                    add_h3(doc, para[i+1])
-                    copy_table(doc, raw.tables[tableIndex])
-                    print(f"Ergebnisse pro Modulfläche {i} table copied - {tableIndex}")
-                    # print(tableIndex)
-                    tableIndex+=1
-                    i+=1
-                except:
-                    break
+    def acquire(self):
+        with self.lock:
+            self.refs += 1
 
-        try:
-            add_h1(doc, f"4. {h1[h1_index]}")
-            h1_index+=1
-        except:
-            pass
-        
-        if "Energiebilanz Sankey-Diagramm" in h1 :
-            add_h2(doc, "Energiebilanz Sankey-Diagramm")
-            try:
-                add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(5.5), height=Inches(6.5))
-                pic_index+=1
-                i+=1
-            except:
-                pass
+    def release(self):
+        with self.lock:
+            self.refs -= 1
+            if self.refs:
+                return
+        for block, view in self.blocks:
+            view.release()
+            block.close()
+            block.unlink()
 
-        if "Datenblatt PV-Modul" in h2 :
-            add_h2(doc, "Datenblatt PV-Modul")
-            i = para.index("Datenblatt PV-Modul")
-            for k in range(i+1, len(para), 1):
-                if 'PV-Modul' in para[k]:
-                    add_h3(doc, para[k])
-                    copy_table(doc, raw.tables[tableIndex])
-                    print(f"Datenblatt PV-Modul pro Modulfläche {k} table copied - {tableIndex}")
-                    tableIndex+=1
-                else:
-                    break
 
-        if "Datenblatt Wechselrichter" in h2 :
-            add_h2(doc, "Datenblatt Wechselrichter")
-            i = para.index("Datenblatt Wechselrichter")
-            while (not para[i+1].startswith("Datenblatt Batteriesystem") and not para[i+1].startswith("Datenblatt Batterie") and not para[i+1].startswith("Schaltplan") and not para[i+1].startswith("Übersichtsplan") and not para[i+1].startswith("Bemaßungsplan") and not para[i+1].startswith("Strangplan") and not para[i+1].startswith("Stückliste")):
-                try:
-                    add_h3(doc, para[i+1])
-                    copy_table(doc, raw.tables[tableIndex])
-                    print(f"Datenblatt Wechselrichter table copied - {tableIndex}")
-                    tableIndex+=1
-                    i+=1
-                except:
-                    break
+@contextmanager
+def attach_pictures(manifest):
+    """
+    Make the pictures of a SharedPictures manifest available to add_picture_inline and the
+    table pictures in a section process.
+    """
+    blocks = []
+    try:
+        for path, (name, size, sha, file_name) in manifest.items():
+            block = shared_memory.SharedMemory(name=name)
+            blocks.append(block)
+            attached_pictures[path] = (block.buf[:size], file_name)
+        yield
+    finally:
+        for view, _ in attached_pictures.values():
+            view.release()
+        attached_pictures.clear()
+        for block in blocks:
+            block.close()
 
-        
-        if "Datenblatt Batteriesystem" in h2 :
-            add_h2(doc, "Datenblatt Batteriesystem")
-            i = para.index("Datenblatt Batteriesystem")
-            while (para[i+1].startswith("Batteriesystem")):
-                add_h3(doc, para[i+1])
-                copy_table(doc, raw.tables[tableIndex])
-                # print(tableIndex)
-                tableIndex+=1
-                i+=1
-
-
-        if "Datenblatt Batterie" in h2 :
-            add_h2(doc, "Datenblatt Batterie")
-            i = para.index("Datenblatt Batterie")
-            try:
-                while (para[i+1] != h1[h1_index]):
-                    add_h3(doc, para[i+1])
-                    copy_table(doc, raw.tables[tableIndex])
-                    # print(tableIndex)
-                    tableIndex+=1
-                    i+=1
-            except:
-                print(f'Total number of tables: {len(raw.tables)})')
-                print(f'table index: {tableIndex}')
-
-        # ----------------------------------------
-        doc.add_page_break()
-        # ----------------------------------------
-        try:
-            add_h1(doc, f"5. {h1[h1_index]}")
-            h1_index+=1
-        except:
-            pass
-        if "Schaltplan" in h2 :
-            add_h2(doc, "Schaltplan")
-            i = para.index("Schaltplan")
-            while True:
-                if i+1 < len(para) and 'Abbildung' in para[i+1]: 
-                    add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(5.5), height=Inches(6.5))
-                    pic_index+=1
-                    i+=1
-                else: 
-                    break
-        if "Übersichtsplan" in h2 :
-            add_h2(doc, "Übersichtsplan")
-            i = para.index("Übersichtsplan")
-            while True:
-                if i+1 < len(para) and 'Abbildung' in para[i+1]: 
-                    add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(5.5), height=Inches(6.5))
-                    pic_index+=1
-                    i+=1
-                else: 
-                    break
 
-        if "Bemaßungsplan" in h2 :
-            add_h2(doc, "Bemaßungsplan")
-            i = para.index("Bemaßungsplan")
-            while True:
-                if i+1 < len(para) and 'Abbildung' in para[i+1]: 
-                    add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(5.5), height=Inches(6.5))
-                    pic_index+=1
-                    i+=1
-                else: 
-                    break
-        doc.add_page_break()
+def get_section_pool():
+    global section_pool
+    if section_pool is None:
+        section_pool = ProcessPoolExecutor(max_workers=SECTION_WORKERS, initializer=section_worker_init)
+    return section_pool
 
-        if "Strangplan" in h2 :
-            add_h2(doc, "Strangplan")
-            i = para.index("Strangplan")
-            while True:
-                if i+1 <= len(para) : 
-                    add_picture_inline(doc, f"{folder_path}/images/{pic_index}", width=Inches(5.5), height=Inches(6.5))
-                    pic_index+=1
-                    i+=1
-                else: 
-                    break
 
-        if "Stückliste" in h2 :
-            add_h2(doc, "Stückliste")
-            i = para.index("Stückliste")
-            add_h3(doc, para[i+1])
-            # print(tableIndex)
-        if "Umgebung" in h2:
-            add_h2(doc, "Umgebung")
-            i = para.index("Umgebung")
-            while True:
-                if i+1 <= len(para) : 
-                    add_picture_inline(doc, f"{folder_path}/images/{2}", width=Inches(5.5), height=Inches(3.5))
-                    i+=1
-                    break
-                else: 
-                    break
-            
-        # ----------------------------------------
-        doc.add_page_break()
-        # ----------------------------------------   
-        
-        add_h1(doc, "6. Warum Solardach24 GmbH?")
-        doc.add_picture("assets/template_images/image2.png", width=Inches(6.5), height=Inches(7))
+def shutdown_section_pool():
+    global section_pool
+    if section_pool is not None:
+        section_pool.shutdown(cancel_futures=True)
+        section_pool = None
+
+
+def section_worker_init():
+    """
+    Start of a section process: metrics and log records are sent back with every fragment,
+    and the process exits when the render process that started it is killed.
+    """
+    global section_collector
+    metrics.reset()
+    section_collector = CollectingHandler()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(section_collector)
+    parent = multiprocessing.parent_process()
+
+    def watch_parent():
+        while parent.is_alive():
+            time.sleep(1.0)
+        os._exit(1)
+    Thread(target=watch_parent, daemon=True).start()
 
-        #add_h1(doc, "7. Vier Köpfe. Für Ihre PV-Anlage.")
-        #doc.add_picture("assets/template_images/image3.png", width=Inches(6.5), height=Inches(7))
 
-        #add_h1(doc, "8. Unser Partner. Für Ihre Sicherheit.")
-        #doc.add_picture("assets/template_images/image4.png", width=Inches(6.5), height=Inches(7))
+def submit_fragments(state, data, template_path):
+    """
+    Plan the recipe for the base counters and the size of every section, and send one run
+    of consecutive sections of about the same size to each process of the section pool.
 
-        #add_h1(doc, "9. Unser Haustechnik-Partner. Für Ihre persönliche Energiewende.")
-        add_h1(doc, "7. Wer wir sind.")
-        doc.add_picture("assets/template_images/image3.png", width=Inches(6.5), height=Inches(7))
+    Returns:
+        dict: Section name -> future of render_fragment.
+    """
+    plan = RenderState(None, state.raw, None)
+    plan.flag = state.flag
+    render_sections(plan)
+    sizes = [(name, 1 + tables + pictures) for name, tables, pictures in plan.usage]
+    share = sum(size for _, size in sizes) / SECTION_WORKERS
+    runs, run, filled = [], [], 0
+    for name, size in sizes:
+        run.append(name)
+        filled += size
+        if filled >= share and len(runs) < SECTION_WORKERS - 1:
+            runs.append(run)
+            run, filled = [], 0
+    if run:
+        runs.append(run)
+    pool = get_section_pool()
+    shared = state.shared
+    manifest = shared.manifest if shared is not None else {}
+    fragments = {}
+    try:
+        for run in runs:
+            future = pool.submit(render_fragment, data, template_path, state.folder_path, state.flag,
+                                 run, plan.bases[run[0]], manifest)
+            if shared is not None:
+                shared.acquire()
+                future.add_done_callback(lambda future: shared.release())
+            fragments.update(dict.fromkeys(run, future))
+    except BaseException:
+        # The runs already sent give their pictures back once cancelled (or done)
+        for future in fragments.values():
+            future.cancel()
+        raise
+    return fragments
 
-        add_h1(doc, "8. Unser Haustechnik-Partner. Für Ihre persönliche Energiewende.")
-        doc.add_picture("assets/template_images/image4.png", width=Inches(5.8), height=Inches(5.5))
 
-        add_h1(doc, "9. Unsere Elektropartner. Für Ihre Sicherheit.")
-        doc.add_picture("assets/template_images/image5.png", width=Inches(6), height=Inches(6))
+def render_fragment(data, template_path, folder_path, job_flag, names, base, manifest):
+    """
+    Render a run of consecutive sections of a report in a section process, into an empty
+    skeleton and starting from the counters `base` of the first one. The pictures of the
+    job are taken from shared memory (see SharedPictures).
 
-        add_h1(doc, "10. Unser Versicherungspartner. Exklusiv bei der Solardach24.")
-        doc.add_picture("assets/template_images/image6.png", width=Inches(5), height=Inches(6))
+    Returns:
+        tuple: The section records (name -> record, see record_section), the pictures they
+        embed that were not shared (sha1 -> bytes), and the metrics and log records of the process.
+    """
+    global flag, fragment_raw
+    flag = job_flag
+    digest = hashlib.sha1(data).hexdigest()
+    if fragment_raw[0] != digest:
+        raw_document = Document(BytesIO(data))
+        remove_prefix_from_title(raw_document)
+        fragment_raw = (digest, RawSnapshot(raw_document))
+    doc, _ = load_skeleton(template_path)
+    state = RenderState(doc, fragment_raw[1], folder_path)
+    state.sections = {}
+    state.cursor, state.table_index, state.pic_index, state.h1_index = base
+    with attach_pictures(manifest):
+        render_sections(state, [entry for entry in COMPILED_RECIPE if entry[0] in names])
+    shared = {sha for _, _, sha, _ in manifest.values()}
+    blobs = {sha: blob for sha, blob in state.blobs.items() if sha not in shared}
+    return state.sections, blobs, metrics.drain(), section_collector.drain()
 
-        add_h1(doc, "11. Unsere Lieferanten. Für die besten Komponenten.")
-        doc.add_picture("assets/template_images/image7.png", width=Inches(6), height=Inches(6))
 
-        add_h1(doc, "12. Gesellschaftliches Engagement und Mitgliedschaften")
-        doc.add_picture("assets/template_images/image8.png", width=Inches(6), height=Inches(6))
+def splice_fragment(state, name, future):
+    """
+    Splice in a section rendered by render_fragment.
 
-        prepare_header(doc, raw)
-        prepare_footer(doc)
-        replace_variables(doc, raw)
-        set_font_to_barlow(doc)
+    Returns:
+        bool: False if there was none or it failed; the section is then rendered here.
+    """
+    if future is None or future.exception() is not None:
+        return False
+    sections, blobs, _, _ = future.result()
+    record = sections[name]
+    pictures = {}
+    for rId, sha in record['images'].items():
+        blob = blobs.get(sha)
+        if blob is None:
+            blob = state.shared.picture(sha)
+            if state.sections is not None:
+                # Kept for the revision store, after the shared memory is gone
+                state.blobs[sha] = bytes(blob)
+        else:
+            state.blobs[sha] = blob
+        pictures[rId] = blob
+    splice_section(state, name, record, pictures)
+    return True
 
-        format_table(doc)
-        darken_first_row_bottom_border(doc)
-        update_module_name(doc)
-        add_page_numbers(doc)  # Call the function here to add page numbers
-        # Remove empty paragraphs and sections
-        #remove_empty_paragraphs(doc)
-        #remove_empty_sections(doc)
-        doc.save(f'{output_folder}/{fileName}-output.docx')
-        print(f'{fileName}-output.docx created')
 
-        clear_folder_contents(fileName,folder_path)
-        print("")
-        print("")
-        print("")
-    except Exception as e:
-        count += 1
-        logging.error(f"\n\n{count}\nAn error occurred", exc_info=True)
-
-        folder_path = os.path.dirname(filepath)
-        for filename in os.listdir(folder_path):
-            file_path = os.path.join(folder_path, filename)
-            if os.path.isfile(file_path) and not filename.endswith('.docx'):
-                os.remove(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-            elif filename.startswith('~$'):
-                os.remove(file_path)
-            elif filename.endswith('.docx') and filename == fileName:
-                src_file = os.path.join(folder_path, filename)
-                dst_file = os.path.join(INVALID_FOLDER, filename)
-                shutil.move(src_file, dst_file)
+def handle_failed_job(fileName, filepath, exc_info=True):
+    """
+    Log the failure and move the raw report to INVALID_FOLDER, cleaning up what the job left behind.
+    Aborted jobs go to QUARANTINE_FOLDER instead. Reports rejected by preflight or aborted get
+    the reasons written next to them.
+    """
+    global count
+    count += 1
+    error = sys.exc_info()[1] if exc_info is True else exc_info
+    destination = QUARANTINE_FOLDER if isinstance(error, JobAbortedError) else INVALID_FOLDER
+    outcome = "failed"
+    if isinstance(error, (PreflightError, JobAbortedError)):
+        outcome = "quarantined" if isinstance(error, JobAbortedError) else "rejected"
+        logging.error(f"\n\n{count}\n{fileName} {outcome}: {error}")
+        try:
+            with open(os.path.join(destination, f"{fileName}.txt"), 'w', encoding='utf-8') as fp:
+                fp.write("\n".join(error.reasons) + "\n")
+        except OSError:
+            logging.error(f"Failed to write the reasons for {fileName}", exc_info=True)
+    else:
+        logging.error(f"\n\n{count}\nAn error occurred", exc_info=exc_info)
+    metrics.inc('docgen_jobs_total', (('outcome', outcome),))
+
+    folder_path = os.path.dirname(filepath)
+    for filename in os.listdir(folder_path):
+        file_path = os.path.join(folder_path, filename)
+        if os.path.isfile(file_path) and not filename.endswith('.docx'):
+            retries.run(f"remove {file_path}", os.remove, file_path)
+        elif os.path.isdir(file_path):
+            retries.run(f"remove {file_path}", shutil.rmtree, file_path)
+        elif filename.startswith('~$'):
+            retries.run(f"remove {file_path}", os.remove, file_path)
+
+    # Journaled as failed once the report has left the watch folder. One that could not be
+    # moved stays queued, so the next scan_backlog picks it up again.
+    dst_file = os.path.join(destination, fileName)
+    try:
+        retries.run(f"move {filepath} to {dst_file}", shutil.move, filepath, dst_file,
+                    on_success=lambda: finish_job(filepath, 'failed', str(error)),
+                    on_failure=lambda move_error: finish_job(filepath, 'queued', str(error)))
+    except OSError:
+        logging.error(f"Failed to move {filepath} to {dst_file}", exc_info=True)
+        finish_job(filepath, 'queued' if os.path.exists(filepath) else 'failed', str(error))
+
+
+def main(fileName, filepath, template_path, output_folder):
+    try:
+        started = time.time()
+        start_job(filepath)
+        with timed_stage('read'):
+            data = read_input(filepath)
+        if PREFLIGHT:
+            with timed_stage('parse'):
+                preflight(fileName, data)
+        with timed_stage('render'):
+            doc = build_offer(fileName, data, template_path)
+        with timed_stage('write'):
+            buffer = BytesIO()
+            save_offer(doc, buffer)
+            write_output({'file_name': fileName, 'src_path': filepath, 'output_folder': output_folder,
+                          'output': buffer.getvalue(), 'sha256': content_hash(data), 'received': started})
+    except Exception:
+        handle_failed_job(fileName, filepath)
                 
 
 if __name__=="__main__":
@@ -1349,6 +4300,11 @@ if __name__=="__main__":
     TEMPLATE_PATH = 'assets/template.docx'
     OUTPUT_FOLDER = 'D:/OneDrive/Office/OneDrive - Solardach24 GmbH/Intranet-Dokumente/10-Verkauf/00-Administration/DocGenerator/output/'
     INVALID_FOLDER = 'D:/OneDrive/Office/OneDrive - Solardach24 GmbH/Intranet-Dokumente/10-Verkauf/00-Administration/DocGenerator/invalid/'
+    QUARANTINE_FOLDER = 'D:/OneDrive/Office/OneDrive - Solardach24 GmbH/Intranet-Dokumente/10-Verkauf/00-Administration/DocGenerator/quarantine/'
+    # (watch folder, template, output folder) of every branch served by this process
+    WATCH_ROUTES = [
+        (WATCH_FOLDER, TEMPLATE_PATH, OUTPUT_FOLDER),
+    ]
     #'''
     '''
     #Testing -- comment this section when testing   
@@ -1356,16 +4312,32 @@ if __name__=="__main__":
     TEMPLATE_PATH = 'assets/template.docx'
     OUTPUT_FOLDER = 'output/'
     INVALID_FOLDER = 'invalid/'
+    QUARANTINE_FOLDER = 'quarantine/'
+    WATCH_ROUTES = [
+        (WATCH_FOLDER, TEMPLATE_PATH, OUTPUT_FOLDER),
+    ]
     '''
     
-    folders = [WATCH_FOLDER, OUTPUT_FOLDER, INVALID_FOLDER]
-    # Check and create folders if needed
-    for folder in folders:
-        if not os.path.exists(folder):
-            os.makedirs(folder)
-            print(f'Created folder: {folder}')
-        else:
-            pass
-    set_(WATCH_FOLDER, TEMPLATE_PATH, OUTPUT_FOLDER)
+    # python word_formatter.py [serve | warm | convert REPORT.docx ...]
+    # One-shot conversions start faster through the warm worker with python warm_client.py REPORT.docx ...
+    command = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    setup_logging()
+    if command == 'warm':
+        serve_warm(TEMPLATE_PATH, OUTPUT_FOLDER)
+    elif command == 'convert':
+        for src_path in sys.argv[2:]:
+            convert_once(src_path, TEMPLATE_PATH, OUTPUT_FOLDER)
+    else:
+        folders = [INVALID_FOLDER, QUARANTINE_FOLDER]
+        for watch_folder, _, output_folder in WATCH_ROUTES:
+            folders += [watch_folder, output_folder]
+        # Check and create folders if needed
+        for folder in folders:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+                log.info(f'Created folder: {folder}')
+            else:
+                pass
+        serve(WATCH_ROUTES)
 
     
\ No newline at end of file